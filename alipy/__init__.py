@@ -4,6 +4,20 @@ This is alipy, a python package to quickly, automatically, and robustly identify
 :Authors: Malte Tewes
 :License: GPLv3
 
+The messages of the verbose functions go through the logging module, to the
+logger "alipy" and its children ("alipy.star", "alipy.quad", ...). alipy
+does not configure this logger : if your application does not configure
+logging either, only the warnings (e.g. "Not enough stars in the reference
+catalog.") get printed, on stderr, and verbose=True alone does not print the
+progress messages (INFO) nor the details of the candidate loops (DEBUG).
+The statistics of these details are only computed if DEBUG is enabled.
+To see the main steps :
+
+::
+
+    import logging
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("alipy").setLevel(logging.INFO)  # or logging.DEBUG
 
 """
 
@@ -11,8 +25,21 @@ __author__ = "Malte Tewes"
 __copyright__ = "2012, Malte Tewes"
 __version__ = "2.0"
 
-from alipy import imgcat, pysex, star, quad, ident, align
-
 __all__ = ["imgcat", "pysex", "star", "quad", "ident", "align"]
 
+# The submodules are imported on first access (alipy.ident, ...), so that
+# e.g. "from alipy import star" does not import all the others :
+_submodules = __all__ + ["catcache", "detect"]
+
+
+def __getattr__(name):
+    if name in _submodules:
+        import importlib
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + _submodules)
+
 
@@ -2,12 +2,14 @@ from . import star
 import os
 import numpy as np
 import math
-import scipy.ndimage
-import astropy.io.fits as pyfits
 import csv
 
+# scipy.ndimage and astropy.io.fits are imported by the functions that use
+# them, so that importing alipy stays fast.
 
-def affineremap(filepath, transform, shape, alifilepath=None, outdir="alipy_out", makepng=False, hdu=0, verbose=True):
+
+def affineremap(filepath, transform, shape, alifilepath=None, outdir="alipy_out", makepng=False, hdu=0, memmap=False,
+                maxmem=None, verbose=True):
     """
     Apply the simple affine transform to the image and saves the result as FITS, without using pyraf.
 
@@ -28,15 +30,21 @@ def affineremap(filepath, transform, shape, alifilepath=None, outdir="alipy_out"
 
     :param hdu: The hdu of the fits file that you want me to use. 0 is primary. If multihdu, 1 is usually science.
 
+    :param memmap: If True, the image is memory-mapped and interpolated in its on-disk dtype and orientation, and the
+        output is float32 (float64 for 32 and 64 bit integer and for float64 input). BSCALE and BZERO are applied to the interpolated image
+        only. This needs much less memory than the default, for instance for int16 images.
+    :type memmap: boolean
+
+    :param maxmem: If set, the image is processed in tiles, each tile reading only the region of the input it needs
+        (memory-mapped, as with memmap=True) and being written directly into the output FITS file. maxmem is the
+        approximate memory budget in bytes for a tile, so that images larger than the memory can be aligned.
+    :type maxmem: int
 
     """
     inv = transform.inverse()
     (matrix, offset) = inv.matrixform()
     # print matrix, offset
 
-    data, hdr = fromfits(filepath, hdu=hdu, verbose=verbose)
-    data = scipy.ndimage.interpolation.affine_transform(data, matrix, offset=offset, output_shape=shape)
-
     basename = os.path.splitext(os.path.basename(filepath))[0]
 
     if alifilepath == None:
@@ -46,7 +54,19 @@ def affineremap(filepath, transform, shape, alifilepath=None, outdir="alipy_out"
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
 
-    tofits(alifilepath, data, hdr=None, verbose=verbose)
+    if maxmem is not None:
+        _tiledremap(filepath, hdu, matrix, offset, shape, alifilepath, maxmem, verbose=verbose)
+        data = None
+    elif memmap:
+        rawdata, hdr = fromfits(filepath, hdu=hdu, verbose=verbose, memmap=True)
+        data = _remapraw(rawdata, hdr, matrix, offset, shape).transpose()
+    else:
+        import scipy.ndimage
+        data, hdr = fromfits(filepath, hdu=hdu, verbose=verbose)
+        data = scipy.ndimage.affine_transform(data, matrix, offset=offset, output_shape=shape)
+
+    if data is not None:
+        tofits(alifilepath, data, hdr=None, verbose=verbose)
 
     if makepng:
         try:
@@ -54,7 +74,10 @@ def affineremap(filepath, transform, shape, alifilepath=None, outdir="alipy_out"
         except ImportError:
             print("Couldn't import f2n -- install it !")
             return
-        myimage = f2n.f2nimage(numpyarray=data, verbose=False)
+        if data is None:
+            myimage = f2n.fromfits(alifilepath, verbose=False)
+        else:
+            myimage = f2n.f2nimage(numpyarray=data, verbose=False)
         myimage.setzscale("auto", "auto")
         myimage.makepilimage("log", negative=False)
         myimage.writetitle(os.path.basename(alifilepath))
@@ -63,6 +86,144 @@ def affineremap(filepath, transform, shape, alifilepath=None, outdir="alipy_out"
         myimage.tonet(os.path.join(outdir, os.path.basename(alifilepath) + ".png"))
 
 
+def _remapraw(rawdata, hdr, matrix, offset, shape):
+    """
+    Interpolation of a raw image as returned by fromfits(memmap=True), in its (y, x) orientation.
+    matrix and offset are given for the usual (x, y) orientation, shape is (width, height).
+    Returns the interpolated and scaled (y, x) image.
+    """
+    (yxmatrix, yxoffset) = _yxform(matrix, offset)
+    return _remapregion(rawdata, hdr, yxmatrix, yxoffset, (shape[1], shape[0]))
+
+
+def _yxform(matrix, offset):
+    """
+    Swaps the axes of the (matrix, offset) of a transform, to work on (y, x) images.
+    """
+    return (np.asarray(matrix)[::-1, ::-1], np.asarray(offset)[::-1])
+
+
+def _remapregion(rawdata, hdr, yxmatrix, yxoffset, outshape):
+    """
+    Interpolates the raw (y, x) image rawdata (or a region of it) with the (y, x) transform yxmatrix, yxoffset, into
+    an output of shape outshape = (height, width), and applies the BSCALE and BZERO of the hdr.
+    """
+    import scipy.ndimage
+    bscale = float(hdr.get("BSCALE", 1.0))
+    bzero = float(hdr.get("BZERO", 0.0))
+    outdtype = _outdtype(rawdata.dtype)
+
+    # We do the spline prefiltering ourselves, to avoid a float64 copy of the full image :
+    filtered = scipy.ndimage.spline_filter(rawdata, order=3, output=outdtype)
+    remapped = scipy.ndimage.affine_transform(filtered, yxmatrix, offset=yxoffset, output_shape=outshape,
+                                              output=outdtype, cval=-bzero / bscale, prefilter=False)
+    del filtered
+    # The interpolation is linear, so we can scale afterwards :
+    if bscale != 1.0:
+        remapped *= bscale
+    if bzero != 0.0:
+        remapped += bzero
+    return remapped
+
+
+# Number of extra pixels read around each input region of a tile : the spline prefilter of a region then matches the
+# one of the full image to float precision.
+_tilemargin = 20
+
+
+def _inputbox(yxmatrix, yxoffset, y0, y1, x0, x1, inshape):
+    """
+    The region (iy0, iy1, ix0, ix1) of the input image needed to interpolate the output pixels [y0:y1, x0:x1],
+    including the margin, clipped to the input image of shape inshape.
+    """
+    corners = np.array([[y0, x0], [y0, x1 - 1], [y1 - 1, x0], [y1 - 1, x1 - 1]], dtype=np.float64)
+    incorners = np.dot(corners, np.asarray(yxmatrix).T) + yxoffset
+    (iy0, ix0) = np.floor(np.min(incorners, axis=0)).astype(int) - _tilemargin
+    (iy1, ix1) = np.ceil(np.max(incorners, axis=0)).astype(int) + _tilemargin + 1
+    return (max(iy0, 0), min(iy1, inshape[0]), max(ix0, 0), min(ix1, inshape[1]))
+
+
+def _tilesize(yxmatrix, outshape, rawitemsize, outitemsize, maxmem):
+    """
+    Chooses the (height, width) of the output tiles so that a tile and its input region use less than about maxmem
+    bytes.
+    """
+    absmatrix = np.abs(np.asarray(yxmatrix))
+    (th, tw) = outshape
+
+    def tilemem(th, tw):
+        inh = absmatrix[0, 0] * th + absmatrix[0, 1] * tw + 2 * _tilemargin + 2
+        inw = absmatrix[1, 0] * th + absmatrix[1, 1] * tw + 2 * _tilemargin + 2
+        return th * tw * outitemsize + inh * inw * (rawitemsize + outitemsize)
+
+    while tilemem(th, tw) > maxmem and max(th, tw) > 16:
+        if th >= tw:
+            th = (th + 1) // 2
+        else:
+            tw = (tw + 1) // 2
+    return (th, tw)
+
+
+def _tiledremap(filepath, hdu, matrix, offset, shape, alifilepath, maxmem, verbose=True):
+    """
+    Out-of-core version of the memmap affineremap : the output FITS file is created with its full size, and filled
+    tile by tile, each tile being interpolated from the memory-mapped region of the input it needs.
+    """
+    import astropy.io.fits as pyfits
+    rawdata, hdr = fromfits(filepath, hdu=hdu, verbose=verbose, memmap=True)
+    (yxmatrix, yxoffset) = _yxform(matrix, offset)
+    outshape = (shape[1], shape[0])
+    outdtype = _outdtype(rawdata.dtype)
+
+    # The pre-sized output file :
+    outhdr = pyfits.PrimaryHDU(data=np.zeros((1, 1), dtype=outdtype)).header
+    outhdr["NAXIS1"] = outshape[1]
+    outhdr["NAXIS2"] = outshape[0]
+    headerbytes = len(outhdr.tostring())
+    databytes = outshape[0] * outshape[1] * outdtype.itemsize
+    if os.path.isfile(alifilepath):
+        os.remove(alifilepath)
+    outhdr.tofile(alifilepath)
+    with open(alifilepath, "rb+") as f:
+        f.seek(headerbytes + int(math.ceil(databytes / 2880.0)) * 2880 - 1)
+        f.write(b"\0")
+    outdata = np.memmap(alifilepath, dtype=outdtype.newbyteorder(">"), mode="r+", offset=headerbytes,
+                        shape=outshape)
+
+    (th, tw) = _tilesize(yxmatrix, outshape, rawdata.dtype.itemsize, outdtype.itemsize, maxmem)
+    if verbose:
+        print("Remapping in %i tiles of (%i, %i) ..." % (
+            int(math.ceil(outshape[0] / float(th)) * math.ceil(outshape[1] / float(tw))), tw, th))
+
+    for y0 in range(0, outshape[0], th):
+        y1 = min(y0 + th, outshape[0])
+        for x0 in range(0, outshape[1], tw):
+            x1 = min(x0 + tw, outshape[1])
+            (iy0, iy1, ix0, ix1) = _inputbox(yxmatrix, yxoffset, y0, y1, x0, x1, rawdata.shape)
+            if iy1 <= iy0 or ix1 <= ix0:  # This tile is outside of the input image
+                outdata[y0:y1, x0:x1] = 0.0
+                continue
+            # The transform for this tile, from its output pixels to its input region :
+            tileoffset = np.dot(yxmatrix, [y0, x0]) + yxoffset - [iy0, ix0]
+            outdata[y0:y1, x0:x1] = _remapregion(np.asarray(rawdata[iy0:iy1, ix0:ix1]), hdr, yxmatrix, tileoffset,
+                                                 (y1 - y0, x1 - x0))
+    outdata.flush()
+    del outdata
+
+    if verbose:
+        print("Wrote %s" % alifilepath)
+
+
+def _outdtype(rawdtype):
+    """
+    The float dtype in which we interpolate raw data of dtype rawdtype : float32 for 8 and 16 bit integers and for float32
+    (of any byte order, FITS data being big-endian), float64 otherwise.
+    """
+    if rawdtype.itemsize <= 2 or (rawdtype.kind == "f" and rawdtype.itemsize == 4):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
 def shape(filepath, hdu=0, verbose=True):
     """
     Returns the 2D shape (width, height) of a FITS image.
@@ -71,6 +232,7 @@ def shape(filepath, hdu=0, verbose=True):
 
 
     """
+    import astropy.io.fits as pyfits
     hdr = pyfits.getheader(filepath, hdu)
     if hdr["NAXIS"] != 2:
         raise RuntimeError("Hmm, this hdu is not a 2D image !")
@@ -79,17 +241,26 @@ def shape(filepath, hdu=0, verbose=True):
     return (int(hdr["NAXIS1"]), int(hdr["NAXIS2"]))
 
 
-def fromfits(infilename, hdu=0, verbose=True):
+def fromfits(infilename, hdu=0, verbose=True, memmap=False):
     """
     Reads a FITS file and returns a 2D numpy array of the data.
     Use hdu to specify which HDU you want (default = primary = 0)
+
+    :param memmap: If True, the data is memory-mapped and returned as it is stored in the file : in its on-disk dtype,
+        without applying BSCALE and BZERO (they remain in the header), and in the (y, x) orientation of the file,
+        i.e. not transposed.
+    :type memmap: boolean
     """
+    import astropy.io.fits as pyfits
 
     if verbose:
         print("Reading %s ..." % (os.path.basename(infilename)))
 
-    pixelarray, hdr = pyfits.getdata(infilename, hdu, header=True)
-    pixelarray = np.asarray(pixelarray).transpose()
+    if memmap:
+        pixelarray, hdr = pyfits.getdata(infilename, hdu, header=True, memmap=True, do_not_scale_image_data=True)
+    else:
+        pixelarray, hdr = pyfits.getdata(infilename, hdu, header=True)
+        pixelarray = np.asarray(pixelarray).transpose()
 
     pixelarrayshape = pixelarray.shape
     if verbose:
@@ -105,6 +276,7 @@ def tofits(outfilename, pixelarray, hdr=None, verbose=True):
     If you specify a header (pyfits format, as returned by fromfits()) it will be used for the image.
     You can give me boolean numpy arrays, I will convert them into 8 bit integers.
     """
+    import astropy.io.fits as pyfits
     pixelarrayshape = pixelarray.shape
     if verbose:
         print("FITS export (%i, %i) %s ..." % (pixelarrayshape[0], pixelarrayshape[1], str(pixelarray.dtype.name)))
@@ -0,0 +1,150 @@
+"""
+A cache of star lists, so that reprocessing images does not need to run the
+source detection again.
+
+The entries are keyed on the content of the image (or on its size and
+modification time), on the hdu, and on all the settings of the detection
+and of the star selection. A changed image or changed settings hence give a
+new entry, and two different images with the same name do not collide.
+Each entry is an index file (see ImgCat.writeindex) holding the selected
+stars, without quads.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+from alipy import imgcat
+
+
+class CatCache:
+    """
+    A directory of cached star lists, with an optional size limit : when it
+    is exceeded, the least recently used entries are removed.
+    """
+
+    def __init__(self, cachedir="alipy_cache", maxsize=None, content=True):
+        """
+        :param cachedir: the directory of the cache (created if needed).
+        :type cachedir: string
+
+        :param maxsize: maximum total size of the cache, in bytes (None for
+                        no limit).
+        :type maxsize: int
+
+        :param content: If True, images are identified by a hash of their
+                        content. If False, by their size and modification
+                        time only, which is faster but less safe.
+        :type content: boolean
+        """
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.content = content
+
+    def key(self, filepath, hdu=0, **settings):
+        """
+        Returns the key of the entry for the image filepath, given the
+        settings (any keyword arguments with a stable repr).
+        """
+        h = filehash(filepath, content=self.content)
+        h.update(("hdu %i" % (hdu)).encode())
+        h.update(("index %i" % (imgcat._indexversion)).encode())
+        for name in sorted(settings):
+            h.update(("%s %r" % (name, settings[name])).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key + ".alipyindex")
+
+    def get(self, key, filepath, verbose=True):
+        """
+        Returns an ImgCat (with its starlist, but no catalog nor quads) for
+        the image filepath, or None if the cache has no entry for key.
+        """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            cached = imgcat.readindex(path, verbose=False)
+            os.utime(path)  # for the LRU
+        except (OSError, ValueError, RuntimeError):
+            return None  # removed by another process, or broken
+        # The same content can come from another file :
+        cached.filepath = filepath
+        cached.name = os.path.splitext(os.path.basename(filepath))[0]
+        if verbose:
+            print("Star list of %s read from the cache (%i stars)" %
+                  (cached.name, len(cached.starlist)))
+        return cached
+
+    def put(self, key, cat, verbose=True):
+        """
+        Stores the starlist of the ImgCat cat under key.
+        """
+        os.makedirs(self.cachedir, exist_ok=True)
+        path = self._path(key)
+        tmppath = "%s.%i.tmp" % (path, os.getpid())
+        cached = imgcat.ImgCat(cat.filepath, hdu=cat.hdu)
+        cached.starlist = cat.starlist
+        cached.mindist = cat.mindist
+        cached.xlim = cat.xlim
+        cached.ylim = cat.ylim
+        cached.writeindex(tmppath, verbose=False)
+        os.replace(tmppath, path)
+        if verbose:
+            print("Star list of %s written to the cache" % (cat.name))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is below
+        maxsize.
+        """
+        if self.maxsize is None or not os.path.isdir(self.cachedir):
+            return
+        entries = []
+        for filename in os.listdir(self.cachedir):
+            if not filename.endswith(".alipyindex"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cachedir, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        entries.sort()
+        total = np.sum([size for (mtime, size, filename) in entries])
+        for (mtime, size, filename) in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(os.path.join(self.cachedir, filename))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Removes all the entries.
+        """
+        self.maxsize, maxsize = 0, self.maxsize
+        try:
+            self.evict()
+        finally:
+            self.maxsize = maxsize
+
+
+def filehash(filepath, content=True):
+    """
+    Returns a hashlib.sha1 object fed with the content of the file (or with
+    its size and modification time if content is False), to which more
+    settings can be added.
+    """
+    h = hashlib.sha1()
+    if content:
+        with open(filepath, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    else:
+        stat = os.stat(filepath)
+        h.update(("%i %i" % (stat.st_size, stat.st_mtime_ns)).encode())
+    return h
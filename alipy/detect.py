@@ -0,0 +1,251 @@
+"""
+A simple built-in source detection, as an alternative to running SExtractor
+through pysex. It is meant for alipy's needs only : finding a few hundred
+reasonably bright stars, with their positions, fluxes, FWHMs, elongations
+and flags.
+
+The steps mimic what SExtractor does with the configuration used by
+ImgCat.makecat :
+ * background and background rms estimation on a grid of meshes,
+ * convolution with the same 3x3 filter as the default pysex filter,
+ * thresholding at DETECT_THRESH times the background rms, keeping only
+   objects with at least DETECT_MINAREA connected pixels,
+ * measurement of the objects (no deblending).
+
+The catalog is returned in memory, as a pysex.ArrayCat with the usual
+SExtractor column names, so that it can go directly into star.readsexcat.
+"""
+
+import os
+import numpy as np
+import scipy.ndimage
+
+from alipy import pysex
+
+
+# The columns that I know how to measure :
+availableparams = ['NUMBER', 'EXT_NUMBER', 'X_IMAGE', 'Y_IMAGE',
+                   'FLUX_AUTO', 'FLUX_ISO', 'FWHM_IMAGE', 'ELONGATION',
+                   'FLAGS', 'ISOAREA_IMAGE']
+
+# Same as the default filter of pysex ("all-ground", FWHM = 2 pixels) :
+_filterkernel = np.array([[1.0, 2.0, 1.0],
+                          [2.0, 4.0, 2.0],
+                          [1.0, 2.0, 1.0]])
+
+
+def run(image, hdu=0, params=availableparams, conf_args={}, verbose=True):
+    """
+    Detects the sources in the image, and returns a pysex.ArrayCat.
+
+    :param image: path to a FITS file, or 2D numpy array (in the (y, x)
+                  orientation of FITS files)
+    :param hdu: The hdu of the FITS file to use. 0 selects the first hdu
+                with some data, as SExtractor would do on a simple image.
+    :param params: list of columns to put in the catalog, among
+                   availableparams.
+    :param conf_args: SExtractor-like configuration. I use DETECT_THRESH
+                      (default 1.5), DETECT_MINAREA (default 5),
+                      SATUR_LEVEL (default 50000.0) and BACK_SIZE
+                      (default 64), and ignore the other ones.
+
+    As in SExtractor, the coordinates start at 1.0 for the center of the
+    first pixel. FLUX_AUTO is approximated by the isophotal flux, and
+    FWHM_IMAGE is computed from the area of the pixels above half of the
+    peak value. FLAGS can contain 4 (saturated) and 8 (truncated).
+    """
+    unknownparams = [param for param in params
+                     if param not in availableparams]
+    if len(unknownparams) > 0:
+        raise RuntimeError("Cannot measure %s, available are %s" % (
+            ", ".join(unknownparams), ", ".join(availableparams)))
+
+    detectthresh = float(conf_args.get('DETECT_THRESH', 1.5))
+    minarea = int(conf_args.get('DETECT_MINAREA', 5))
+    saturlevel = float(conf_args.get('SATUR_LEVEL', 50000.0))
+    backsize = int(conf_args.get('BACK_SIZE', 64))
+
+    if isinstance(image, str):
+        (data, extnumber) = _readimage(image, hdu)
+        if verbose:
+            print("Detecting sources in %s ..." % (os.path.basename(image)))
+    else:
+        (data, extnumber) = (np.asarray(image), max(hdu, 1))
+    data = np.asarray(data, dtype=np.float32)
+
+    (back, backrms) = background(data, backsize=backsize)
+    subdata = data - back
+    filtered = scipy.ndimage.convolve(subdata,
+                                      _filterkernel / np.sum(_filterkernel),
+                                      mode="nearest")
+    detected = filtered > detectthresh * backrms
+
+    # Connected pixels, 8-connectivity :
+    (labels, nlabels) = scipy.ndimage.label(detected,
+                                            structure=np.ones((3, 3)))
+    areas = np.bincount(labels.ravel(), minlength=nlabels + 1)
+    keep = areas >= minarea
+    keep[0] = False  # the background
+    # We renumber the objects that we keep, 0 for all the rest :
+    newlabels = np.zeros(nlabels + 1, dtype=np.intp)
+    newlabels[keep] = np.arange(1, np.sum(keep) + 1)
+    labels = newlabels[labels]
+    nobjects = int(np.sum(keep))
+
+    measures = _measure(subdata, data, labels, nobjects, saturlevel)
+    measures['NUMBER'] = np.arange(1, nobjects + 1)
+    measures['EXT_NUMBER'] = np.full(nobjects, extnumber, dtype=int)
+
+    if verbose:
+        print("Background %.1f (rms %.1f), detected %i sources" % (
+            float(np.median(back)), float(np.median(backrms)), nobjects))
+
+    return pysex.ArrayCat([(param, measures[param]) for param in params])
+
+
+def _readimage(filepath, hdu):
+    """
+    Reads the (y, x) data of the FITS file, and returns it with the
+    EXT_NUMBER that SExtractor would give to its sources.
+    """
+    import astropy.io.fits as pyfits
+    hdulist = pyfits.open(filepath)
+    try:
+        if hdu == 0:
+            for (i, hdudata) in enumerate(hdulist):
+                if hdudata.data is not None and hdudata.data.ndim == 2:
+                    return (np.array(hdudata.data), max(i, 1))
+            raise RuntimeError("No 2D image in %s" % (filepath))
+        return (np.array(hdulist[hdu].data), hdu)
+    finally:
+        hdulist.close()
+
+
+def background(data, backsize=64, nsigma=3.0, niter=3):
+    """
+    Estimates the background and its rms on meshes of backsize x backsize
+    pixels, with a sigma-clipped median, smooths them with a 3x3 median
+    filter on the grid of meshes and interpolates them to the full image.
+
+    Returns two arrays (back, backrms) of the shape of data.
+    """
+    (ny, nx) = data.shape
+    (nmy, nmx) = (max(1, int(np.ceil(ny / float(backsize)))),
+                  max(1, int(np.ceil(nx / float(backsize)))))
+    padded = np.full((nmy * backsize, nmx * backsize), np.nan,
+                     dtype=np.float32)
+    padded[:ny, :nx] = data
+    meshes = padded.reshape(nmy, backsize, nmx, backsize)
+    meshes = meshes.transpose(0, 2, 1, 3).reshape(nmy, nmx, -1)
+
+    # Sigma-clipping, all meshes at once :
+    for i in range(niter):
+        med = np.nanmedian(meshes, axis=2)
+        std = np.nanstd(meshes, axis=2)
+        outliers = np.abs(meshes - med[:, :, None]) > nsigma * std[:, :, None]
+        meshes = np.where(outliers, np.nan, meshes)
+    meshback = np.nanmedian(meshes, axis=2)
+    meshrms = np.nanstd(meshes, axis=2)
+
+    meshback = scipy.ndimage.median_filter(meshback, size=3, mode="nearest")
+    meshrms = scipy.ndimage.median_filter(meshrms, size=3, mode="nearest")
+
+    # Bilinear interpolation between the mesh centers :
+    back = _interpmeshes(meshback, ny, nx, backsize)
+    backrms = _interpmeshes(meshrms, ny, nx, backsize)
+    return (back, backrms)
+
+
+def _interpmeshes(meshvalues, ny, nx, backsize):
+    """
+    Bilinear interpolation of the (nmy, nmx) values at the mesh centers to
+    the full (ny, nx) image, constant beyond the outer mesh centers. This is
+    done along x first, on the small (nmy, nx) array, and then along y, so
+    that no full-size coordinate arrays are needed.
+    """
+    meshvalues = meshvalues.astype(np.float32)
+    (iy0, iy1, wy) = _interpweights(ny, meshvalues.shape[0], backsize)
+    (ix0, ix1, wx) = _interpweights(nx, meshvalues.shape[1], backsize)
+    rows = meshvalues[:, ix0] * (1.0 - wx) + meshvalues[:, ix1] * wx
+    image = rows[iy0]
+    image *= (1.0 - wy)[:, None]
+    image += rows[iy1] * wy[:, None]
+    return image
+
+
+def _interpweights(n, nmeshes, backsize):
+    """
+    For each of the n pixels along an axis, the indexes of the two
+    surrounding mesh centers and the weight of the second one.
+    """
+    coords = (np.arange(n) + 0.5) / backsize - 0.5
+    coords = np.clip(coords, 0.0, nmeshes - 1.0)
+    i0 = np.minimum(np.floor(coords).astype(np.intp), max(nmeshes - 2, 0))
+    i1 = np.minimum(i0 + 1, nmeshes - 1)
+    weights = (coords - i0).astype(np.float32)
+    return (i0, i1, weights)
+
+
+def _measure(subdata, data, labels, nobjects, saturlevel):
+    """
+    Measures all the objects of the labels image at once.
+    subdata is the background subtracted image, data the original one.
+    Returns a dict of columns.
+    """
+    (ny, nx) = subdata.shape
+    inobject = labels > 0
+    objlabels = labels[inobject]
+    values = subdata[inobject].astype(np.float64)
+    (ys, xs) = np.nonzero(inobject)
+    xs = xs.astype(np.float64)
+    ys = ys.astype(np.float64)
+
+    def objsum(weights):
+        return np.bincount(objlabels, weights=weights,
+                           minlength=nobjects + 1)[1:]
+
+    area = objsum(None)
+    flux = objsum(values)
+
+    # Barycenter and second order moments, with positive weights :
+    weights = np.clip(values, 0.0, None)
+    wsum = objsum(weights)
+    wsum[wsum <= 0.0] = 1.0
+    xmean = objsum(weights * xs) / wsum
+    ymean = objsum(weights * ys) / wsum
+    dx = xs - xmean[objlabels - 1]
+    dy = ys - ymean[objlabels - 1]
+    x2 = objsum(weights * dx * dx) / wsum
+    y2 = objsum(weights * dy * dy) / wsum
+    xy = objsum(weights * dx * dy) / wsum
+    # Semi-major and minor axes :
+    root = np.sqrt(((x2 - y2) / 2.0) ** 2 + xy ** 2)
+    a = np.sqrt(np.clip((x2 + y2) / 2.0 + root, 0.0, None))
+    b = np.sqrt(np.clip((x2 + y2) / 2.0 - root, 0.0, None))
+    elongation = a / np.clip(b, 1.0e-3, None)
+
+    # FWHM from the area of the pixels above half of the peak :
+    peak = scipy.ndimage.maximum(subdata, labels,
+                                 np.arange(1, nobjects + 1))
+    peak = np.asarray(peak, dtype=np.float64).reshape(-1)
+    abovehalf = values > 0.5 * peak[objlabels - 1]
+    halfarea = objsum(abovehalf.astype(np.float64))
+    fwhm = 2.0 * np.sqrt(halfarea / np.pi)
+
+    # Flags :
+    flags = np.zeros(nobjects, dtype=int)
+    saturated = objsum((data[inobject] >= saturlevel).astype(np.float64))
+    flags[saturated > 0] += 4
+    onborder = np.logical_or(np.logical_or(xs == 0, xs == nx - 1),
+                             np.logical_or(ys == 0, ys == ny - 1))
+    truncated = objsum(onborder.astype(np.float64))
+    flags[truncated > 0] += 8
+
+    return {'X_IMAGE': xmean + 1.0,
+            'Y_IMAGE': ymean + 1.0,
+            'FLUX_AUTO': flux,
+            'FLUX_ISO': flux,
+            'FWHM_IMAGE': fwhm,
+            'ELONGATION': elongation,
+            'FLAGS': flags,
+            'ISOAREA_IMAGE': area.astype(int)}
@@ -1,10 +1,18 @@
 from alipy import imgcat
+from alipy import catcache
 from alipy import quad
 from alipy import star
 import sys
 import os
+import copy
+import time
+import itertools
+import logging
+import concurrent.futures
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 
 class Identification:
     """
@@ -19,9 +27,10 @@ class Identification:
     :ivar ok: boolean, True if the idendification was successful.
     :ivar trans: The SimpleTransform object that represents the geometrical
                  transform from ukn to ref.
-    :ivar uknmatchstars: A list of Star objects of the catalog of the
+    :ivar uknmatchstars: A StarTable (or list of Star objects, if the
+                         ImgCat starlists are lists) of the catalog of the
                          unknown image...
-    :ivar refmatchstars: ... that correspond to these Star objects of the
+    :ivar refmatchstars: ... that correspond to these stars of the
                          reference image.
     :ivar medfluxratio: Median flux ratio between the 
                         images: "ukn * medfluxratio = ref"
@@ -29,16 +38,37 @@ class Identification:
                         It gets computed by the method calcfluxratio, using
                         the matched stars.
     :ivar stdfluxratio: Standard error on the flux ratios of the matched stars.
+    :ivar rms: RMS of the distances between the refined transform of the
+               fitted unknown stars and their reference stars.
+    :ivar verified: dict of the candidates already tested by findtrans, keyed
+                    on the star indexes of their two quads (and on r and
+                    minnident), with the result of the test.
+    :ivar verifhits: number of candidate tests that were read from verified.
+    :ivar verifmisses: number of candidate tests that were actually run.
+    :ivar stats: dict of the wall times and counters of findtrans, see
+                 imgcat.recordstats : stages "proposecands", "identify"
+                 (the tests of candidates), "refit" and "findtrans", with
+                 the counters "ncands" (candidates tested), "nkdqueries"
+                 (hashes searched in the KD-trees of quads) and "nidentify"
+                 (stars searched in the KD-tree of the ref), and the values
+                 "reflevel" (the quadlevels of the ref used) and
+                 "uknquadlevel". The times of the ImgCat stages are in
+                 self.ref.stats and self.ukn.stats.
+    :ivar callback: if not None, called after each of these stages, as
+                    callback(self, stage, seconds, counts).
     """
 
     def __init__(self, ref, ukn):
         """
-        :param ref: The reference image
-        :type ref: ImgCat object
+        :param ref: The reference image, or the path to an index file
+                    written by ImgCat.writeindex
+        :type ref: ImgCat object or string
         :param ukn: The unknown image, whose transform will be adjusted to 
                     match the ref
         :type ukn: ImgCat object
         """
+        if not isinstance(ref, imgcat.ImgCat):
+            ref = imgcat.readindex(ref, verbose=False)
         self.ref = ref
         self.ukn = ukn
 
@@ -52,21 +82,56 @@ class Identification:
         self.medfluxratio = None  # ukn * medfluxratio 
                                   # --> ref (high value means shallow image)
         self.stdfluxratio = None
+        self.rms = None
+
+        self.verified = {}
+        self.verifhits = 0
+        self.verifmisses = 0
+
+        self.stats = {}
+        self.callback = None
 
-    def findtrans(self, r=5.0, verbose=True):
+    def findtrans(self, r=5.0, verbose=True, earlyreject=True, batch=False,
+                  ncands=4, nsigma=3.0, maxiter=10):
         """
         Find the best trans given the quads, and tests if the match is
         sufficient
+
+        :param verbose: If True, the progress is logged (see the logging
+                        section of the alipy docstring : without a logging
+                        configuration, only the warnings get printed).
+        :type verbose: boolean
+
+        :param earlyreject: If True, the candidate transforms are tested with
+                            star.hasmatches, that stops as soon as the answer
+                            is known, instead of star.identify on all stars.
+                            The result is the same.
+        :type earlyreject: boolean
+        :param batch: If True, all the candidates of a quadlevel are tested
+                      at once, with star.countmatches. This makes a larger
+                      ncands affordable. The first candidate that passes is
+                      kept, as without batch.
+        :type batch: boolean
+        :param ncands: Number of candidates to test at each quadlevel.
+        :type ncands: int
+        :param nsigma: The transform found is refined by star.refinetrans,
+                       clipping the stars further than nsigma times the RMS
+                       (None for no clipping), ...
+        :type nsigma: float
+        :param maxiter: ... with at most maxiter fits.
+        :type maxiter: int
         """
 
+        starttime = time.perf_counter()
+
         # Some robustness checks
         if len(self.ref.starlist) < 4:
             if verbose:
-                print("Not enough stars in the reference catalog.")
+                logger.warning("Not enough stars in the reference catalog.")
             return
         if len(self.ukn.starlist) < 4:
             if verbose:
-                print("Not enough stars in the unknown catalog.")
+                logger.warning("Not enough stars in the unknown catalog.")
             return
 
         # First question : how many stars should match ?
@@ -80,28 +145,41 @@ class Identification:
         # Hmm, arbitrary for now :
         minquaddist = 0.005
 
-        # Let's start :
+        # Let's start. We use the quads of the ref level by level, as for
+        # the ukn : if the ref already has more levels (e.g., all of them,
+        # made once in run() for all the ukns), the others are not used yet.
         if self.ref.quadlevel == 0:
             self.ref.makemorequads(verbose=verbose)
         if self.ukn.quadlevel == 0:
             self.ukn.makemorequads(verbose=verbose)
+        reflevel = 1
 
+        candfinder = quad.CandFinder()
         while self.ok == False:
-            # Find the best candidates
-            cands = quad.proposecands(
-                self.ukn.quadlist, self.ref.quadlist, n=4, verbose=verbose)
+            # Find the best candidates, among the quads of all the levels :
+            proposetime = time.perf_counter()
+            nqueries = candfinder.nqueries
+            cands = candfinder.propose(
+                self.ukn.quadindex, self.ref.quadindex.uptolevel(reflevel),
+                n=ncands, verbose=verbose)
+            imgcat.recordstats(self, "proposecands",
+                               time.perf_counter() - proposetime,
+                               nkdqueries=candfinder.nqueries - nqueries)
 
             if len(cands) != 0 and cands[0]["dist"] < minquaddist:
                 # If no quads are available, we directly try to make more ones.
-                for cand in cands:
+                if batch:
+                    identoks = self._verifybatch(cands, minnident, r=r,
+                                                 verbose=verbose)
+                for (i, cand) in enumerate(cands):
                     # Check how many stars are identified...
-                    nident = star.identify(self.ukn.starlist,
-                                           self.ref.starlist,
-                                           trans=cand["trans"],
-                                           r=r,
-                                           verbose=verbose,
-                                           getstars=False)
-                    if nident >= minnident:
+                    if batch:
+                        identok = identoks[i]
+                    else:
+                        identok = self._verify(cand, minnident, r=r,
+                                               earlyreject=earlyreject,
+                                               verbose=verbose)
+                    if identok:
                         self.trans = cand["trans"]
                         self.cand = cand
                         self.ok = True
@@ -109,43 +187,103 @@ class Identification:
 
             if self.ok == False:
                 # We add more quads...
-                addedmorerefquads = self.ref.makemorequads(verbose=verbose)
+                if reflevel < self.ref.quadlevel:
+                    addedmorerefquads = True
+                else:
+                    addedmorerefquads = self.ref.makemorequads(
+                        verbose=verbose)
+                reflevel = min(reflevel + 1, self.ref.quadlevel)
                 addedmoreuknquads = self.ukn.makemorequads(verbose=verbose)
 
                 if addedmorerefquads == False and addedmoreuknquads == False:
                     break  # get out of the while, we failed.
 
+        self.stats["reflevel"] = reflevel
+        self.stats["uknquadlevel"] = self.ukn.quadlevel
+
         if self.ok:  # we refine the transform
-            # get matching stars :
-            (self.uknmatchstars, self.refmatchstars) = \
-                                              star.identify(self.ukn.starlist,
-                                                            self.ref.starlist,
-                                                            trans=self.trans,
-                                                            r=r,
-                                                            verbose=False,
-                                                            getstars=True)
-            # refit the transform on them :
+            refittime = time.perf_counter()
             if verbose:
-                print("Refitting transform (before/after) :")
-                print((self.trans))
-            newtrans = star.fitstars(self.uknmatchstars, self.refmatchstars)
-            if newtrans != None:
-                self.trans = newtrans
-                if verbose:
-                    print((self.trans))
-            # Generating final matched star lists :
-            (self.uknmatchstars, self.refmatchstars) = \
-                                       star.identify(self.ukn.starlist,
-                                                     self.ref.starlist,
-                                                     trans=self.trans,
-                                                     r=r,
-                                                     verbose=verbose,
-                                                     getstars=True)
+                logger.info("Refitting transform (before/after) :")
+                logger.info("%s", self.trans)
+            (self.trans, self.uknmatchstars, self.refmatchstars,
+             self.rms) = star.refinetrans(self.ukn.starlist,
+                                          self.ref.starlist, self.trans, r=r,
+                                          nsigma=nsigma, maxiter=maxiter,
+                                          verbose=verbose)
+            imgcat.recordstats(self, "refit", time.perf_counter() - refittime,
+                               nmatches=len(self.uknmatchstars))
             if verbose:
-                print("I'm done !")
+                logger.info("%s", self.trans)
+                logger.info("I'm done !")
         else:
             if verbose:
-                print("Failed to find transform !")
+                logger.info("Failed to find transform !")
+        imgcat.recordstats(self, "findtrans", time.perf_counter() - starttime)
+
+    def _verify(self, cand, minnident, r=5.0, earlyreject=True,
+                verbose=True):
+        """
+        Tells if the transform of the candidate identifies at least minnident
+        stars. The same pair of quads is often proposed again at the next
+        quadlevels : the result is then taken from self.verified.
+        """
+        key = (_quadkey(cand["uknquad"]), _quadkey(cand["refquad"]), r,
+               minnident)
+        if key in self.verified:
+            self.verifhits += 1
+            if verbose:
+                logger.debug("Candidate already tested")
+            return self.verified[key]
+        self.verifmisses += 1
+
+        starttime = time.perf_counter()
+        if earlyreject:
+            (identok, ntested) = star.hasmatches(
+                self.ukn.starlist, self.ref.starlist, cand["trans"],
+                minnident, r=r, verbose=verbose, getntested=True)
+        else:
+            nident = star.identify(self.ukn.starlist,
+                                   self.ref.starlist,
+                                   trans=cand["trans"],
+                                   r=r,
+                                   verbose=verbose,
+                                   getstars=False)
+            identok = nident >= minnident
+            ntested = len(self.ukn.starlist)
+        imgcat.recordstats(self, "identify", time.perf_counter() - starttime,
+                           ncands=1, nidentify=ntested)
+        self.verified[key] = identok
+        return identok
+
+    def _verifybatch(self, cands, minnident, r=5.0, verbose=True):
+        """
+        Like _verify, for a list of candidates, that are tested all at once.
+        Returns the list of results.
+        """
+        keys = [(_quadkey(cand["uknquad"]), _quadkey(cand["refquad"]), r,
+                 minnident) for cand in cands]
+        totest = [i for (i, key) in enumerate(keys)
+                  if key not in self.verified]
+        self.verifhits += len(cands) - len(totest)
+        self.verifmisses += len(totest)
+        if len(totest) > 0:
+            starttime = time.perf_counter()
+            nidents = star.countmatches(self.ukn.starlist, self.ref.starlist,
+                                        [cands[i]["trans"] for i in totest],
+                                        r=r)
+            imgcat.recordstats(self, "identify",
+                               time.perf_counter() - starttime,
+                               ncands=len(totest),
+                               nidentify=len(totest) * len(self.ukn.starlist))
+            for (i, nident) in zip(totest, nidents):
+                self.verified[keys[i]] = bool(nident >= minnident)
+        results = [self.verified[key] for key in keys]
+        if verbose:
+            logger.debug("Tested %i candidates at once (%i already tested), "
+                         "%i passed", len(totest), len(cands) - len(totest),
+                         sum(results))
+        return results
 
     def calcfluxratio(self, verbose=True):
         """
@@ -159,7 +297,7 @@ class Identification:
         assert len(self.uknmatchstars) == len(self.refmatchstars)
         if len(self.refmatchstars) == 0:
             if verbose:
-                print("No matching stars to compute flux ratio !")
+                logger.info("No matching stars to compute flux ratio !")
             return
 
         reffluxes = star.listtoarray(self.refmatchstars, full=True)[:, 2]
@@ -170,10 +308,9 @@ class Identification:
         self.stdfluxratio = float(np.std(fluxratios))
 
         if verbose:
-            print((("Computed flux ratio from %i matches : "
-                   "median %.2f, std %.2f") % (len(reffluxes),
-                                               self.medfluxratio,
-                                               self.stdfluxratio)))
+            logger.info("Computed flux ratio from %i matches : "
+                        "median %.2f, std %.2f", len(reffluxes),
+                        self.medfluxratio, self.stdfluxratio)
 
     def showmatch(self, show=False, verbose=True):
         """
@@ -196,16 +333,14 @@ class Identification:
         plt.scatter(a[:, 0], a[:, 1], s=10.0, color="black")
 
         # The ukn in red
-        a = star.listtoarray(
-            self.trans.applystarlist(self.ukn.starlist), full=True)
+        a = self.trans.applyarray(star.listtoarray(self.ukn.starlist))
         plt.scatter(a[:, 0], a[:, 1], s=2.0, color="red")
-        a = star.listtoarray(
-            self.trans.applystarlist(self.uknmatchstars), full=True)
+        a = self.trans.applyarray(star.listtoarray(self.uknmatchstars))
         plt.scatter(a[:, 0], a[:, 1], s=6.0, color="red")
 
         # The quad
 
-        polycorners = star.listtoarray(self.cand["refquad"].stars)
+        polycorners = self.cand["refquad"].coords()
         polycorners = imgcat.ccworder(polycorners)
         plt.fill(polycorners[:, 0], polycorners[
                  :, 1], alpha=0.1, ec="none", color="red")
@@ -222,13 +357,14 @@ class Identification:
             plt.show()
         else:
             if not os.path.isdir("alipy_visu"):
-                os.makedirs("alipy_visu")
+                os.makedirs("alipy_visu", exist_ok=True)
             plt.savefig(
                 os.path.join("alipy_visu", self.ukn.name + "_match.png"))
 
 
 def run(ref, ukns, hdu=0, visu=True, skipsaturated=False,
-        r=5.0, n=500, sexkeepcat=False, sexrerun=True, verbose=True):
+        r=5.0, n=500, sexkeepcat=False, sexrerun=True, verbose=True,
+        workers=None, backend="sextractor", cache=None, callback=None):
     """
     Top-level function to identify transorms between images.
 
@@ -236,6 +372,9 @@ def run(ref, ukns, hdu=0, visu=True, skipsaturated=False,
     further.
 
     :param ref: path to a FITS image file that will act as the "reference".
+                Alternatively, the path to an index file written by
+                ImgCat.writeindex, or an ImgCat object : the reference is then
+                used as it is, without running SExtractor on it.
     :type ref: string
 
     :param ukns: list of paths to FITS files to be "aligned" on the reference.
@@ -268,6 +407,40 @@ def run(ref, ukns, hdu=0, visu=True, skipsaturated=False,
                      instead of running SExtractor again on the images.
     :type sexrerun: boolean
 
+    :param verbose: If True, the progress of the identifications is logged,
+                    through the logging module. Unless your application
+                    configures logging (see the alipy docstring), this
+                    alone only prints the warnings, and the messages of
+                    SExtractor and of the catalog reading.
+    :type verbose: boolean
+
+    :param workers: If more than 1, the ukns are processed in parallel by
+                    this number of processes. The reference is prepared only
+                    once, here, and sent to each process. The results are
+                    the same as without workers, and in the same order.
+    :type workers: int
+
+    :param backend: The source detection to use : "sextractor" (via pysex),
+                    or "builtin" (alipy.detect, no external program).
+    :type backend: string
+
+    :param cache: A catcache.CatCache, or the path of its directory. If
+                  given, the star lists of the images are taken from this
+                  cache when the same images were already processed with the
+                  same settings, and put into it otherwise. This replaces
+                  sexkeepcat and sexrerun, which are then ignored.
+    :type cache: CatCache
+
+    :param callback: If not None, it is set as the callback of all the
+                     ImgCat and Identification objects, and gets called as
+                     callback(obj, stage, seconds, counts) after each stage
+                     of the processing (see imgcat.recordstats). With
+                     workers, it is called in the worker processes, and must
+                     hence be a module-level function. The recorded times
+                     and counters are anyway in the stats dicts of the
+                     returned Identifications and of their ImgCats.
+    :type callback: function
+
     .. todo:: Make this guy accept existing asciidata catalogs, instead of
               only FITS images.
 
@@ -275,37 +448,156 @@ def run(ref, ukns, hdu=0, visu=True, skipsaturated=False,
     """
 
     if verbose:
-        print((10 * "#", " Preparing reference ..."))
-    ref = imgcat.ImgCat(ref, hdu=hdu)
-    ref.makecat(rerun=sexrerun, keepcat=sexkeepcat, verbose=verbose)
-    ref.makestarlist(skipsaturated=skipsaturated, n=n, verbose=verbose)
+        logger.info("%s  Preparing reference ...", 10 * "#")
+    refindexpath = None
+    if isinstance(ref, imgcat.ImgCat):
+        pass
+    elif imgcat.isindex(ref):
+        indexpath = ref
+        ref = imgcat.readindex(indexpath, verbose=verbose)
+        if ref.quadlevel > 0:  # then ref is exactly what the file contains
+            refindexpath = indexpath
+    else:
+        ref = _makeimgcat(ref, hdu=hdu, skipsaturated=skipsaturated, n=n,
+                          sexkeepcat=sexkeepcat, sexrerun=sexrerun,
+                          backend=backend, cache=cache, callback=callback,
+                          verbose=verbose)
+        if visu:
+            ref.showstars(verbose=verbose)
+    if callback is not None:
+        ref.callback = callback
+    # We make all the quads of the ref now : the ref is then read only,
+    # and shared by all the identifications (that use its quads level by
+    # level).
+    while ref.makemorequads(verbose=verbose):
+        refindexpath = None  # the file does not contain everything
+
+    options = {"hdu": hdu, "visu": visu, "skipsaturated": skipsaturated,
+               "r": r, "n": n, "sexkeepcat": sexkeepcat,
+               "sexrerun": sexrerun, "backend": backend, "cache": cache,
+               "callback": callback, "verbose": verbose}
+
+    if workers is not None and workers > 1:
+        # What we send to the processes : the index file if we have one
+        # (quick to read, memory-mapped), otherwise the ImgCat without its
+        # catalog, that the processes do not need.
+        if refindexpath is not None:
+            workerref = refindexpath
+        else:
+            workerref = copy.copy(ref)
+            workerref.cat = None
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_initworker,
+                initargs=(workerref,)) as executor:
+            identifications = list(executor.map(_identifyinworker, ukns,
+                                                itertools.repeat(options)))
+        for idn in identifications:
+            idn.ref = ref
+    else:
+        identifications = [_identify(ref, ukn, **options) for ukn in ukns]
+
     if visu:
-        ref.showstars(verbose=verbose)
-    ref.makemorequads(verbose=verbose)
+        ref.showquads(verbose=verbose)
 
-    identifications = []
+    return identifications
 
-    for ukn in ukns:
 
-        if verbose:
-            print((10 * "#", "Processing %s" % (ukn)))
+def _identify(ref, ukn, hdu=0, visu=True, skipsaturated=False,
+              r=5.0, n=500, sexkeepcat=False, sexrerun=True, verbose=True,
+              backend="sextractor", cache=None, callback=None):
+    """
+    Processes a single unknown image for run(), and returns its
+    Identification.
 
-        ukn = imgcat.ImgCat(ukn, hdu=hdu)
-        ukn.makecat(rerun=sexrerun, keepcat=sexkeepcat, verbose=verbose)
-        ukn.makestarlist(skipsaturated=skipsaturated, n=n, verbose=verbose)
-        if visu:
-            ukn.showstars(verbose=verbose)
+    The ref must have all its quads (see run) : it is then not modified,
+    and the results are independent of the order and of the number of
+    workers.
+    """
+    if verbose:
+        logger.info("%s Processing %s", 10 * "#", ukn)
 
-        idn = Identification(ref, ukn)
-        idn.findtrans(verbose=verbose, r=r)
-        idn.calcfluxratio(verbose=verbose)
-        identifications.append(idn)
+    ukn = _makeimgcat(ukn, hdu=hdu, skipsaturated=skipsaturated, n=n,
+                      sexkeepcat=sexkeepcat, sexrerun=sexrerun,
+                      backend=backend, cache=cache, callback=callback,
+                      verbose=verbose)
+    if visu:
+        ukn.showstars(verbose=verbose)
 
-        if visu:
-            ukn.showquads(verbose=verbose)
-            idn.showmatch(verbose=verbose)
+    idn = Identification(ref, ukn)
+    idn.callback = callback
+    idn.findtrans(verbose=verbose, r=r)
+    idn.calcfluxratio(verbose=verbose)
 
     if visu:
-        ref.showquads(verbose=verbose)
+        ukn.showquads(verbose=verbose)
+        idn.showmatch(verbose=verbose)
 
-    return identifications
+    return idn
+
+
+def _makeimgcat(filepath, hdu=0, skipsaturated=False, n=500,
+                sexkeepcat=False, sexrerun=True, backend="sextractor",
+                cache=None, callback=None, verbose=True):
+    """
+    Returns the ImgCat of an image with its starlist, for run(), from the
+    cache if possible.
+    """
+    if cache is None:
+        cat = imgcat.ImgCat(filepath, hdu=hdu)
+        cat.callback = callback
+        cat.makecat(rerun=sexrerun, keepcat=sexkeepcat, backend=backend,
+                    verbose=verbose)
+        cat.makestarlist(skipsaturated=skipsaturated, n=n, verbose=verbose)
+        return cat
+
+    if isinstance(cache, str):
+        cache = catcache.CatCache(cache)
+    key = cache.key(filepath, hdu=hdu, skipsaturated=skipsaturated, n=n,
+                    backend=backend, params=imgcat.catparams,
+                    conf_args=sorted(imgcat.catconf_args.items()))
+    cat = cache.get(key, filepath, verbose=verbose)
+    if cat is None:
+        cat = imgcat.ImgCat(filepath, hdu=hdu)
+        cat.callback = callback
+        cat.makecat(backend=backend, verbose=verbose)
+        cat.makestarlist(skipsaturated=skipsaturated, n=n, verbose=verbose)
+        cache.put(key, cat, verbose=verbose)
+    else:
+        cat.callback = callback
+    return cat
+
+
+def _quadkey(q):
+    """
+    What identifies a quad for Identification.verified : the indexes of its
+    stars in the starlist, or, if unknown, its stars.
+    """
+    if q.indexes is not None:
+        return tuple(q.indexes)
+    return tuple([(s.x, s.y) for s in q.stars])
+
+
+# The reference ImgCat of a worker process of run() :
+_workerref = None
+
+
+def _initworker(ref):
+    """
+    Initializer of the worker processes of run() : ref is an ImgCat or the
+    path to an index file.
+    """
+    global _workerref
+    if isinstance(ref, imgcat.ImgCat):
+        _workerref = ref
+    else:
+        _workerref = imgcat.readindex(ref, verbose=False)
+
+
+def _identifyinworker(ukn, options):
+    """
+    Runs _identify in a worker process (pysex gives each extraction its own
+    temporary directory, so the processes do not clobber each other).
+    """
+    idn = _identify(_workerref, ukn, **options)
+    idn.ref = None  # No need to send it back, run() puts its own.
+    return idn
@@ -2,13 +2,36 @@ from alipy import star
 from alipy import pysex
 from alipy import quad
 import os
+import time
+import logging
 import numpy as np
 
 
+# The source detection settings of ImgCat.makecat :
+catconf_args = {'DETECT_THRESH': 3.0,
+                'ANALYSIS_THRESH': 3.0,
+                'DETECT_MINAREA': 10,
+                'PIXEL_SCALE': 1.0,
+                'SEEING_FWHM': 2.0,
+                "FILTER": "Y",
+                'CATALOG_TYPE': 'FITS_1.0'}
+catparams = ['X_IMAGE', 'Y_IMAGE',
+             'FLUX_AUTO', 'FWHM_IMAGE',
+             'FLAGS', 'ELONGATION',
+             'NUMBER', "EXT_NUMBER"]
+
+logger = logging.getLogger(__name__)
+
+
 class ImgCat:
     """
     Represent an individual image and its associated catalog, starlist,
     quads etc.
+
+    The wall times of makecat, makestarlist and of each level of
+    makemorequads, and the numbers of stars and of quads per level, are
+    recorded in the dict self.stats (see recordstats). If self.callback is
+    set, it gets called after each of these stages.
     """
 
     def __init__(self, filepath, hdu=0, cat=None):
@@ -33,16 +56,22 @@ class ImgCat:
 
         self.hdu = hdu
         self.cat = cat
-        self.starlist = []
+        self.starlist = star.StarTable()
         self.mindist = 0.0
         self.xlim = (0.0, 0.0)  # Will be set using the catalog
                                # -- no need for the FITS image.
         self.ylim = (0.0, 0.0)
 
         self.quadlist = []
+        self.quadhashes = np.zeros((0, 4))  # their hashes, as a (K, 4) array
+        self.quadkeys = set()  # their quantized hashes, see quad.hashkeys
+        self.quadindex = quad.QuadIndex()  # the same quads, indexed
         self.quadlevel = 0  # encodes what kind of quads have already
                            # been computed
 
+        self.stats = {}
+        self.callback = None
+
     def __str__(self):
         return ("%20s: approx %4i x %4i, %4i stars, "
                 "%4i quads, quadlevel %i") % (os.path.basename(self.filepath),
@@ -52,33 +81,62 @@ class ImgCat:
                                               len(self.quadlist),
                                               self.quadlevel)
 
-    def makecat(self, rerun=True, keepcat=False, verbose=True):
-        self.cat = pysex.run(
-            self.filepath,
-            conf_args={'DETECT_THRESH': 3.0,
-                       'ANALYSIS_THRESH': 3.0,
-                       'DETECT_MINAREA': 10,
-                       'PIXEL_SCALE': 1.0,
-                       'SEEING_FWHM': 2.0,
-                       "FILTER": "Y",
-                       'VERBOSE_TYPE': 'NORMAL' if verbose else 'QUIET'},
-            params=['X_IMAGE', 'Y_IMAGE',
-                    'FLUX_AUTO', 'FWHM_IMAGE',
-                    'FLAGS', 'ELONGATION',
-                    'NUMBER', "EXT_NUMBER"],
-            rerun=rerun,
-            keepcat=keepcat,
-            catdir="alipy_cats")
-
-    def makestarlist(self, skipsaturated=False, n=200, verbose=True):
+    def makecat(self, rerun=True, keepcat=False, runner=None,
+                backend="sextractor", verbose=True):
+        """
+        Runs SExtractor on the image, via pysex, or the built-in source
+        detection of alipy.detect.
+
+        :param runner: the pysex.Runner to use (by default, the one shared
+                       by all pysex.run calls).
+        :type runner: pysex.Runner
+
+        :param backend: "sextractor" or "builtin". The builtin one does not
+                        need SExtractor nor asciidata, and keeps the catalog
+                        in memory (rerun and keepcat are then ignored).
+        :type backend: string
+        """
+        starttime = time.perf_counter()
+        conf_args = dict(catconf_args)
+        params = catparams[:]
+
+        if backend == "builtin":
+            from alipy import detect
+            self.cat = detect.run(self.filepath, hdu=self.hdu,
+                                  params=params, conf_args=conf_args,
+                                  verbose=verbose)
+        elif backend == "sextractor":
+            conf_args['VERBOSE_TYPE'] = 'NORMAL' if verbose else 'QUIET'
+            self.cat = pysex.run(
+                self.filepath,
+                conf_args=conf_args,
+                params=params,
+                rerun=rerun,
+                keepcat=keepcat,
+                catdir="alipy_cats",
+                runner=runner)
+        else:
+            raise RuntimeError("Unknown backend %s" % (backend))
+        recordstats(self, "makecat", time.perf_counter() - starttime,
+                    nsources=0 if self.cat is None else self.cat.nrows)
+
+    def makestarlist(self, skipsaturated=False, n=200, compact=False,
+                     verbose=True):
+        """
+        Builds self.starlist, a StarTable of the n brightest sources.
+
+        :param compact: If True, the StarTable uses float32 columns.
+        :type compact: boolean
+        """
         if self.cat:
+            starttime = time.perf_counter()
             if skipsaturated:
                 maxflag = 3
             else:
                 maxflag = 7
-            self.starlist = star.sortstarlistbyflux(
-                star.readsexcat(self.cat, hdu=self.hdu,
-                                maxflag=maxflag, verbose=verbose))[:n]
+            self.starlist = star.readsexcat(self.cat, hdu=self.hdu,
+                                            maxflag=maxflag, verbose=verbose,
+                                            table=True, compact=compact, n=n)
             (xmin, xmax, ymin, ymax) = star.area(self.starlist, border=0.01)
             self.xlim = (xmin, xmax)
             self.ylim = (ymin, ymax)
@@ -86,6 +144,8 @@ class ImgCat:
             # Given this starlists, what is a good minimal distance for stars
             # in quads ?
             self.mindist = min(min(xmax - xmin, ymax - ymin) / 10.0, 30.0)
+            recordstats(self, "makestarlist", time.perf_counter() - starttime,
+                        nstars=len(self.starlist))
 
         else:
             raise RuntimeError("No cat : call makecat first !")
@@ -96,8 +156,11 @@ class ImgCat:
         """
         # if not add:
         #    self.quadlist = []
+        starttime = time.perf_counter()
+        nold = len(self.quadlist)
         if verbose:
-            print(("Making more quads, from quadlevel %i ..." % self.quadlevel))
+            logger.info("Making more quads, from quadlevel %i ...",
+                        self.quadlevel)
         if self.quadlevel == 0:
             self.quadlist.extend(
                 quad.makequads1(self.starlist, n=7,
@@ -129,10 +192,84 @@ class ImgCat:
         else:
             return False
 
-        self.quadlist = quad.removeduplicates(self.quadlist, verbose=verbose)
+        newquads = self.quadlist[nold:]
+        del self.quadlist[nold:]
+        for newquad in newquads:
+            newquad.level = self.quadlevel
+
+        # We keep only the new quads that are not already there, and the old
+        # ones stay as they are :
+        (newquads, newhashes) = quad.newunique(
+            newquads, np.array([q.hash for q in newquads]).reshape(-1, 4),
+            self.quadkeys, verbose=verbose, nold=nold)
+        self.quadlist.extend(newquads)
+        self.quadhashes = np.vstack([self.quadhashes, newhashes])
+        self.quadindex.add(newquads, hashes=newhashes, level=self.quadlevel)
+
         self.quadlevel += 1
+        self.stats["quadlevel"] = self.quadlevel
+        recordstats(self, "makemorequads%i" % (self.quadlevel - 1),
+                    time.perf_counter() - starttime,
+                    **{"nquads%i" % (self.quadlevel - 1): len(newquads)})
         return True
 
+    def writeindex(self, filepath, verbose=True):
+        """
+        Saves the starlist and all the quads made so far (hashes, star indexes
+        and quadlevels) into a single binary file, that can be read back with
+        readindex() much faster than running makecat, makestarlist and
+        makemorequads again. Typical use, for a reference image :
+
+        ::
+
+            ref.makestarlist()
+            while ref.makemorequads():
+                pass
+            ref.writeindex("ref.alipyindex")
+
+        The file is a numpy .npy file holding one single record, so that
+        readindex() can memory-map it.
+        Only the standard columns of the starlist are kept, not the other
+        props.
+        """
+        table = star.listtotable(self.starlist)
+        for q in self.quadlist:
+            if q.indexes is None:
+                raise RuntimeError("Quad %s has no star indexes, "
+                                   "cannot write the index" % (str(q)))
+
+        namelen = max([1] + [len(name) for name in table.name])
+        record = np.zeros((), dtype=_indexdtype(
+            nstars=len(table), nquads=len(self.quadlist), namelen=namelen,
+            filepathlen=max(1, len(self.filepath)),
+            floattype=table.x.dtype))
+
+        record["alipyindex"] = _indexversion
+        record["filepath"] = self.filepath
+        record["hdu"] = self.hdu
+        record["quadlevel"] = self.quadlevel
+        record["mindist"] = self.mindist
+        record["xlim"] = self.xlim
+        record["ylim"] = self.ylim
+        for field in ["x", "y", "flux", "fwhm", "elon", "flags"]:
+            record[field] = getattr(table, field)
+        record["starnames"] = table.name
+        if len(self.quadlist) > 0:
+            if len(self.quadhashes) == len(self.quadlist):
+                record["hashes"] = self.quadhashes
+            else:  # the quadlist was not made by makemorequads
+                record["hashes"] = [q.hash for q in self.quadlist]
+            record["indexes"] = [q.indexes for q in self.quadlist]
+            record["levels"] = [-1 if q.level is None else q.level
+                                for q in self.quadlist]
+
+        with open(filepath, "wb") as f:
+            np.save(f, record)
+        if verbose:
+            print(("Wrote index of %s : %i stars, %i quads, quadlevel %i" %
+                   (self.name, len(table), len(self.quadlist),
+                    self.quadlevel)))
+
     def showstars(self, verbose=True):
         """
         Uses f2n to write a png image with circled stars.
@@ -155,7 +292,7 @@ class ImgCat:
         # myimage.writeinfo(["This is a demo", "of some possibilities",
         #                    "of f2n.py"], colour=(255,100,0))
         if not os.path.isdir("alipy_visu"):
-            os.makedirs("alipy_visu")
+            os.makedirs("alipy_visu", exist_ok=True)
         myimage.tonet(os.path.join("alipy_visu", self.name + "_stars.png"))
 
     def showquads(self, show=False, flux=True, verbose=True):
@@ -185,7 +322,7 @@ class ImgCat:
 
         if len(self.quadlist) != 0:
             for quad in self.quadlist:
-                polycorners = star.listtoarray(quad.stars)
+                polycorners = quad.coords()
                 polycorners = ccworder(polycorners)
                 plt.fill(polycorners[:, 0],
                          polycorners[:, 1],
@@ -203,10 +340,137 @@ class ImgCat:
             plt.show()
         else:
             if not os.path.isdir("alipy_visu"):
-                os.makedirs("alipy_visu")
+                os.makedirs("alipy_visu", exist_ok=True)
             plt.savefig(os.path.join("alipy_visu", self.name + "_quads.png"))
 
 
+def recordstats(obj, stage, seconds, **counts):
+    """
+    Records a stage of the processing into obj.stats, a dict with :
+
+     * "times" : the total wall time of each stage, in seconds,
+     * "calls" : the number of times each stage was run,
+     * "counts" : counters, summed over the calls,
+
+    plus some values that are simply set by the stages (like "quadlevel").
+    Then, if obj.callback is not None, calls
+    obj.callback(obj, stage, seconds, counts).
+
+    :param obj: an ImgCat or an Identification
+    :param stage: name of the stage, e.g. "makecat" or "makemorequads2"
+    :type stage: string
+    :param counts: counters of this call, e.g. nstars=200
+    """
+    times = obj.stats.setdefault("times", {})
+    times[stage] = times.get(stage, 0.0) + seconds
+    calls = obj.stats.setdefault("calls", {})
+    calls[stage] = calls.get(stage, 0) + 1
+    totals = obj.stats.setdefault("counts", {})
+    for (name, value) in counts.items():
+        totals[name] = totals.get(name, 0) + value
+    if obj.callback is not None:
+        obj.callback(obj, stage, seconds, counts)
+
+
+# Version number of the index files written by ImgCat.writeindex :
+_indexversion = 1
+
+
+def _indexdtype(nstars, nquads, namelen, filepathlen, floattype):
+    """
+    The numpy dtype of the single record of an index file.
+    """
+    return np.dtype([
+        ("alipyindex", np.int32),
+        ("filepath", "U%i" % filepathlen),
+        ("hdu", np.int64),
+        ("quadlevel", np.int64),
+        ("mindist", np.float64),
+        ("xlim", np.float64, (2,)),
+        ("ylim", np.float64, (2,)),
+        ("x", floattype, (nstars,)),
+        ("y", floattype, (nstars,)),
+        ("flux", floattype, (nstars,)),
+        ("fwhm", floattype, (nstars,)),
+        ("elon", floattype, (nstars,)),
+        ("flags", np.int64, (nstars,)),
+        ("starnames", "U%i" % namelen, (nstars,)),
+        ("hashes", np.float64, (nquads, 4)),
+        ("indexes", np.int64, (nquads, 4)),
+        ("levels", np.int64, (nquads,))])
+
+
+def isindex(filepath):
+    """
+    Tells if filepath is an index file written by ImgCat.writeindex (and
+    not, e.g., a FITS image).
+    """
+    if not isinstance(filepath, str) or not os.path.isfile(filepath):
+        return False
+    with open(filepath, "rb") as f:
+        if f.read(6) != b"\x93NUMPY":
+            return False
+    try:
+        record = np.load(filepath, mmap_mode="r")
+    except ValueError:
+        return False
+    return record.dtype.names is not None and \
+        "alipyindex" in record.dtype.names
+
+
+def readindex(filepath, verbose=True):
+    """
+    Reads an index file written by ImgCat.writeindex, and returns an ImgCat
+    with its starlist, quadlist and quadindex ready to be used (e.g. as
+    reference of an Identification). No catalog is available.
+
+    The file is memory-mapped, the columns of the starlist are views into it.
+    """
+    record = np.load(filepath, mmap_mode="r")
+    if record.dtype.names is None or "alipyindex" not in record.dtype.names:
+        raise RuntimeError("%s is not an alipy index file" % (filepath))
+    if int(record["alipyindex"]) != _indexversion:
+        raise RuntimeError("Unknown index version in %s" % (filepath))
+
+    refcat = ImgCat(str(record["filepath"]), hdu=int(record["hdu"]))
+    refcat.starlist = star.StarTable(
+        x=record["x"], y=record["y"], flux=record["flux"],
+        fwhm=record["fwhm"], elon=record["elon"], name=record["starnames"],
+        flags=record["flags"],
+        compact=(record["x"].dtype == np.float32))
+    refcat.mindist = float(record["mindist"])
+    refcat.xlim = tuple(record["xlim"].tolist())
+    refcat.ylim = tuple(record["ylim"].tolist())
+    refcat.quadlevel = int(record["quadlevel"])
+    refcat.stats["quadlevel"] = refcat.quadlevel
+
+    hashes = np.asarray(record["hashes"])
+    indexes = np.asarray(record["indexes"])
+    levels = np.asarray(record["levels"])
+    refcat.quadlist = [quad.Quad.fromtable(refcat.starlist, quadindexes,
+                                           quadhash, None if level < 0
+                                           else level) for
+                       (quadindexes, quadhash, level)
+                       in zip(indexes.tolist(), hashes.tolist(),
+                              levels.tolist())]
+    # One tree per quadlevel, as makemorequads would do :
+    if np.all(np.diff(levels) >= 0):
+        for level in np.unique(levels):
+            chunk = np.flatnonzero(levels == level)
+            refcat.quadindex.add([refcat.quadlist[i] for i in chunk],
+                                 hashes=hashes[chunk],
+                                 level=None if level < 0 else int(level))
+    else:
+        refcat.quadindex.add(refcat.quadlist, hashes=hashes)
+    refcat.quadhashes = hashes.reshape(-1, 4)
+    refcat.quadkeys = set(quad.hashkeys(hashes))
+    if verbose:
+        print(("Read index of %s : %i stars, %i quads, quadlevel %i" %
+               (refcat.name, len(refcat.starlist), len(refcat.quadlist),
+                refcat.quadlevel)))
+    return refcat
+
+
 def ccworder(a):
     """
     Sorting a coordinate array CCW to plot polygons ...
@@ -8,7 +8,8 @@ sextractor catalog.
 
 Dependencies:
  - sextractor (mandatory)
- - astroasciidata (mandatory)
+ - astroasciidata (needed to read ASCII catalogs)
+ - astropy (needed to read FITS catalogs, CATALOG_TYPE FITS_1.0 or FITS_LDAC)
  - numpy (optional, needed for the array support)
  - pyfits (optional, needed for the array support)
 
@@ -19,36 +20,28 @@ Usage:
                     params=['X_IMAGE', 'Y_IMAGE', 'FLUX_APER'],
                     conf_args={'PHOT_APERTURES':5})
     print(cat['FLUX_APER'])
+
+To run several extractions, possibly concurrently, use a Runner :
+    with pysex.Runner(workers=4) as runner:
+        cats = runner.map(myimages, params=['X_IMAGE', 'Y_IMAGE'])
 """
 
 import os
 import shutil
-import asciidata
-
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+import multiprocessing.util
 
 
-def _check_files(conf_file, conf_args, verbose=True):
-    if conf_file is None:
-        os.system("sex -d > .pysex.sex")
-        conf_file = '.pysex.sex'
-    if "FILTER_NAME" not in conf_args or \
-       not os.path.isfile(conf_args['FILTER_NAME']):
-        if verbose:
-            print('No filter file found, using default filter')
-        f = open('.pysex.conv', 'w')
-        f.write("""CONV NORM \n
+_defaultconv = """CONV NORM \n
 # 3x3 ``all-ground'' convolution mask with FWHM = 2 pixels.\n
 1 2 1\n
 2 4 2\n
-1 2 1\n""")
-        f.close()
-        conf_args['FILTER_NAME'] = '.pysex.conv'
-    if 'STARNNW_NAME' not in conf_args or \
-       not os.path.isfile(conf_args['STARNNW_NAME']):
-        if verbose:
-            print('No NNW file found, using default NNW config')
-        f = open('.pysex.nnw', 'w')
-        f.write("""NNW
+1 2 1\n"""
+
+_defaultnnw = """NNW
 # Neural Network Weights for the SExtractor star/galaxy classifier (V1.3)
 # inputs:     9 for profile parameters + 1 for seeing.
 # outputs:      ``Stellarity index'' (0.0 to 1.0)
@@ -75,54 +68,340 @@ def _check_files(conf_file, conf_args, verbose=True):
 
 
  0.00000e+00
- 1.00000e+00""")
-        f.close()
-        conf_args['STARNNW_NAME'] = '.pysex.nnw'
+ 1.00000e+00"""
 
-    return conf_file, conf_args
+
+def _read_cat(path='.pysex.cat'):
+    """
+    Reads a catalog written by SExtractor. FITS catalogs (CATALOG_TYPE
+    FITS_1.0 or FITS_LDAC) are read into an ArrayCat, the ASCII ones with
+    asciidata.
+    """
+    with open(path, 'rb') as f:
+        isfits = f.read(9) == b"SIMPLE  ="
+    if isfits:
+        return _read_fitscat(path)
+    import asciidata
+    cat = asciidata.open(path)
+    return cat
 
 
-def _setup(conf_file, params):
-    try:
-        shutil.copy(conf_file, '.pysex.sex')
-    except:
-        pass  # already created in _check_files
+def _read_fitscat(path):
+    """
+    Reads a FITS_1.0 or FITS_LDAC catalog into an ArrayCat, with columns in
+    native byte order. The objects tables of all the extensions are put one
+    after the other (EXT_NUMBER tells them apart).
+    """
+    import numpy as np
+    import astropy.io.fits as pyfits
+    with pyfits.open(path, memmap=False) as hdulist:
+        tables = [hdu for hdu in hdulist
+                  if isinstance(hdu, pyfits.BinTableHDU)]
+        ldactables = [hdu for hdu in tables
+                      if hdu.header.get("EXTNAME") == "LDAC_OBJECTS"]
+        if len(ldactables) > 0:
+            tables = ldactables
+        if len(tables) == 0:
+            raise RuntimeError("No catalog table in %s" % (path))
+        colnames = tables[0].columns.names
+        columns = []
+        for colname in colnames:
+            data = np.concatenate([hdu.data[colname] for hdu in tables])
+            data = data.astype(data.dtype.newbyteorder('='))
+            columns.append((colname, data))
+    return ArrayCat(columns)
+
+
+class ArrayColumn:
+    """
+    A catalog column holding a numpy array, with the same interface as the
+    asciidata columns used by alipy.
+    """
 
-    f = open('.pysex.param', 'w')
-    f.write('\n'.join(params))
-    f.close()
+    def __init__(self, colname, data):
+        self.colname = colname
+        self.data = data
 
+    def __getitem__(self, i):
+        return self.data[i]
 
-def _setup_img(image, name):
-    if not type(image) == type(''):
-        import astropy.io.fits as pyfits
-        pyfits.writeto(name, image)
+    def __iter__(self):
+        return iter(self.data)
 
+    def __len__(self):
+        return len(self.data)
 
-def _get_cmd(img, img_ref, conf_args):
-    ref = img_ref if img_ref is not None else ''
-    cmd = ' '.join(['sex', ref, img, '-c .pysex.sex '])
-    args = [''.join(['-', key, ' ', str(conf_args[key])]) for key in conf_args]
-    cmd += ' '.join(args)
-    return cmd
+    def tonumpy(self):
+        return self.data
 
 
-def _read_cat(path='.pysex.cat'):
-    cat = asciidata.open(path)
-    return cat
+class ArrayCat:
+    """
+    A catalog made of numpy columns, that can be used instead of an
+    asciidata catalog (cat['X_IMAGE'], cat.nrows, iteration over the
+    columns...).
+    """
+
+    def __init__(self, columns):
+        """
+        columns : list of (colname, array) tuples, all arrays of the same
+                  length.
+        """
+        import numpy as np
+        self.columns = [ArrayColumn(colname, np.asarray(data))
+                        for (colname, data) in columns]
+        lengths = set([len(col) for col in self.columns])
+        if len(lengths) > 1:
+            raise RuntimeError("Columns of different lengths !")
+        self.nrows = lengths.pop() if len(lengths) == 1 else 0
+        self.ncols = len(self.columns)
+
+    def __getitem__(self, colname):
+        for col in self.columns:
+            if col.colname == colname:
+                return col
+        raise KeyError(colname)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __str__(self):
+        return "ArrayCat of %i rows : %s" % (
+            self.nrows, ", ".join([col.colname for col in self.columns]))
+
+
+class Runner:
+    """
+    Runs SExtractor, as many times as you want.
+
+    The configuration, filter and NNW files are written only once, in a
+    private directory of the Runner, and each extraction then gets its own
+    temporary directory for its parameter file and catalog. Hence several
+    extractions can run at the same time, from different threads (see map)
+    or processes, without clobbering each other's files.
+    """
+
+    def __init__(self, conf_file=None, sexpath="sex", timeout=None,
+                 workers=1, verbose=True):
+        """
+        :param conf_file: optional, SExtractor configuration file to use.
+                          By default I use the output of "sex -d".
+        :param sexpath: the SExtractor executable.
+        :param timeout: in seconds, maximum duration of an extraction.
+        :type timeout: float
+        :param workers: number of extractions that map runs at the same time.
+        :type workers: int
+        """
+        self.conf_file = conf_file
+        self.sexpath = sexpath
+        self.timeout = timeout
+        self.workers = workers
+        self.verbose = verbose
+        self.confdir = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Removes the configuration files.
+        """
+        with self._lock:
+            if self.confdir is not None:
+                shutil.rmtree(self.confdir, ignore_errors=True)
+                self.confdir = None
+
+    def _setupconf(self):
+        """
+        Writes the configuration, filter and NNW files, if not yet done.
+        """
+        with self._lock:
+            if self.confdir is not None:
+                return
+            confdir = tempfile.mkdtemp(prefix="pysex_")
+            try:
+                if self.conf_file is None:
+                    with open(os.path.join(confdir, 'pysex.sex'), 'wb') as f:
+                        subprocess.run([self.sexpath, "-d"], stdout=f,
+                                       check=True, timeout=self.timeout)
+                else:
+                    shutil.copy(self.conf_file,
+                                os.path.join(confdir, 'pysex.sex'))
+                with open(os.path.join(confdir, 'pysex.conv'), 'w') as f:
+                    f.write(_defaultconv)
+                with open(os.path.join(confdir, 'pysex.nnw'), 'w') as f:
+                    f.write(_defaultnnw)
+            except BaseException as err:
+                shutil.rmtree(confdir, ignore_errors=True)
+                if isinstance(err, (OSError, subprocess.SubprocessError)):
+                    raise RuntimeError("Could not write the SExtractor "
+                                       "configuration : %s" % (err))
+                raise
+            self.confdir = confdir
+
+    def _getargs(self, img, img_ref, conf_args, workdir, verbose=True):
+        """
+        Builds the SExtractor command line, as a list of arguments.
+        """
+        conf_args = dict(conf_args)
+        if "FILTER_NAME" not in conf_args or \
+           not os.path.isfile(conf_args['FILTER_NAME']):
+            if verbose:
+                print('No filter file found, using default filter')
+            conf_args['FILTER_NAME'] = os.path.join(self.confdir, 'pysex.conv')
+        if 'STARNNW_NAME' not in conf_args or \
+           not os.path.isfile(conf_args['STARNNW_NAME']):
+            if verbose:
+                print('No NNW file found, using default NNW config')
+            conf_args['STARNNW_NAME'] = os.path.join(self.confdir, 'pysex.nnw')
+        conf_args['CATALOG_NAME'] = os.path.join(workdir, 'pysex.cat')
+        conf_args['PARAMETERS_NAME'] = os.path.join(workdir, 'pysex.param')
+
+        args = [self.sexpath]
+        if img_ref:
+            args.append(img_ref)
+        args.extend([img, '-c', os.path.join(self.confdir, 'pysex.sex')])
+        for key in conf_args:
+            args.extend(['-' + key, str(conf_args[key])])
+        return args
+
+    def run(self, image='', imageref='', params=[], conf_args={},
+            keepcat=True, rerun=False, catdir=None, verbose=None):
+        """
+        Runs SExtractor on one image, see the module function run for the
+        parameters. Contrary to run, I raise a RuntimeError if SExtractor
+        cannot be run, fails or times out.
+
+        verbose : overrides the verbose of the Runner for this extraction.
+        """
+        if verbose is None:
+            verbose = self.verbose
+        if isinstance(image, str) and (keepcat or not rerun):
+            catpath = _catpath(image, catdir, key=self._catkey(
+                image, imageref, params, conf_args))
+            if keepcat and catdir:
+                os.makedirs(catdir, exist_ok=True)
+            # Checking if permanent catalog already exists :
+            if rerun == False and os.path.exists(catpath):
+                return _read_cat(catpath)
+
+        self._setupconf()
+        with tempfile.TemporaryDirectory(prefix="pysex_") as workdir:
+            if not isinstance(image, str):
+                import astropy.io.fits as pyfits
+                im_name = os.path.join(workdir, 'pysex.fits')
+                pyfits.writeto(im_name, image.transpose())
+            else:
+                im_name = image
+            if not isinstance(imageref, str):
+                import astropy.io.fits as pyfits
+                imref_name = os.path.join(workdir, 'pysex.ref.fits')
+                pyfits.writeto(imref_name, imageref.transpose())
+            else:
+                imref_name = imageref
+            with open(os.path.join(workdir, 'pysex.param'), 'w') as f:
+                f.write('\n'.join(params))
+
+            args = self._getargs(im_name, imref_name, conf_args, workdir,
+                                 verbose=verbose)
+            try:
+                res = subprocess.run(args, timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                raise RuntimeError("SExtractor timed out on %s" % (im_name))
+            except (OSError, subprocess.SubprocessError) as err:
+                raise RuntimeError("Could not run SExtractor (%s) : %s" % (
+                    self.sexpath, err))
+            if res.returncode != 0:
+                raise RuntimeError("SExtractor failed on %s (code %i)" % (
+                    im_name, res.returncode))
+
+            catname = os.path.join(workdir, 'pysex.cat')
+            # Keeping the cat at a permanent location :
+            if keepcat and isinstance(image, str):
+                tmpcatpath = catpath + "." + os.path.basename(workdir)
+                shutil.copy(catname, tmpcatpath)
+                os.replace(tmpcatpath, catpath)
+            return _read_cat(catname)
+
+    def _catkey(self, image, imageref, params, conf_args):
+        """
+        Key of the permanent catalog of image : a hash of the content of the
+        image (and of the imageref) and of the settings of the extraction.
+        """
+        from alipy import catcache
+        h = catcache.filehash(image)
+        if isinstance(imageref, str):
+            if imageref:
+                h.update(catcache.filehash(imageref).digest())
+        else:
+            import numpy as np
+            h.update(np.ascontiguousarray(imageref).tobytes())
+        if self.conf_file is not None:
+            h.update(catcache.filehash(self.conf_file).digest())
+        h.update(("params %r" % (list(params))).encode())
+        h.update(("conf_args %r" % (sorted(
+            [(key, str(value)) for (key, value) in conf_args.items()
+             if key != 'VERBOSE_TYPE']))).encode())
+        return h.hexdigest()[:16]
+
+    def map(self, images, **kwargs):
+        """
+        Runs SExtractor on each of the images, with up to self.workers of
+        them at the same time. The keyword arguments are those of run.
+
+        Returns the list of catalogs, in the order of the images.
+        """
+        if self.workers is None or self.workers <= 1:
+            return [self.run(image, **kwargs) for image in images]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as executor:
+            futures = [executor.submit(self.run, image, **kwargs)
+                       for image in images]
+            return [future.result() for future in futures]
+
+
+def _catpath(image, catdir, key):
+    """
+    Permanent catalog filepath of an image, given the key of its content and
+    settings (see Runner._catkey).
+    """
+    (imgdir, filename) = os.path.split(image)
+    (common, ext) = os.path.splitext(filename)
+    catfilename = "%s.%s.pysexcat" % (common, key)
+    if catdir:
+        return os.path.join(catdir, catfilename)
+    return os.path.join(imgdir, catfilename)
+
 
+# The Runners used by run, one per process and conf_file :
+_runners = {}
+_runnerslock = threading.Lock()
 
-def _cleanup():
-    files = [f for f in os.listdir('.') if '.pysex.' in f]
-    for f in files:
-        os.remove(f)
 
-# def run(image='', imageref='', params=[], conf_file=DEFAULT_CONF,
-# conf_args={}):
+def _getrunner(conf_file=None):
+    """
+    Returns the Runner of this process for conf_file. Its configuration
+    files are removed when the process exits, also for the worker processes
+    of multiprocessing and concurrent.futures, that do not run the atexit
+    functions. A forked process does not reuse the Runner of its parent, as
+    the parent can remove its files at any time.
+    """
+    key = (os.getpid(), conf_file)
+    with _runnerslock:
+        if key not in _runners:
+            runner = Runner(conf_file=conf_file)
+            multiprocessing.util.Finalize(runner, runner.close,
+                                          exitpriority=10)
+            _runners[key] = runner
+        return _runners[key]
 
 
 def run(image='', imageref='', params=[], conf_file=None,
-        conf_args={}, keepcat=True, rerun=False, catdir=None):
+        conf_args={}, keepcat=True, rerun=False, catdir=None, runner=None):
     """
     Run sextractor on the given image with the given parameters.
 
@@ -136,8 +415,16 @@ def run(image='', imageref='', params=[], conf_file=None,
     keepcat : should I keep the sex cats ?
     rerun : should I rerun sex even when a cat is already present ?
     catdir : where to put the cats (default : next to the images)
+             The kept cats are named after the image and a hash of its
+             content and of the settings (imageref, params, conf_file,
+             conf_args), so that with rerun=False a cat is only reused for
+             the very same image and settings.
+    runner : optional, the Runner to use (conf_file is then ignored). By
+             default I use a Runner shared by all calls with the same
+             conf_file, so that the configuration files are written once.
 
-    Returns an asciidata catalog containing the sextractor output
+    Returns an asciidata catalog containing the sextractor output, or None
+    if sextractor failed.
 
     Usage exemple:
             import pysex
@@ -146,64 +433,15 @@ def run(image='', imageref='', params=[], conf_file=None,
                             conf_args={'PHOT_APERTURES':5})
             print(cat['FLUX_APER'])
     """
-    # Preparing permanent catalog filepath :
-    (imgdir, filename) = os.path.split(image)
-    (common, ext) = os.path.splitext(filename)
-    catfilename = common + \
-        ".pysexcat"  # Does not get deleted by _cleanup(),
-                     # even if in working dir !
-    if keepcat:
-        if catdir:
-            if not os.path.isdir(catdir):
-                os.makedirs(catdir)
-                # raise RuntimeError("Directory \"%s\" for pysex cats does not
-                # exist. Make it !" % (catdir))
-
-    if catdir:
-        catpath = os.path.join(catdir, catfilename)
-    else:
-        catpath = os.path.join(imgdir, catfilename)
-
-    # Checking if permanent catalog already exists :
-    if rerun == False and type(image) == type(''):
-        if os.path.exists(catpath):
-            cat = _read_cat(catpath)
-            return cat
-
-    # Otherwise we run sex :
-    conf_args['CATALOG_NAME'] = '.pysex.cat'
-    conf_args['PARAMETERS_NAME'] = '.pysex.param'
-    if 'VERBOSE_TYPE' in conf_args and conf_args['VERBOSE_TYPE'] == 'QUIET':
-        verbose = False
-    else:
-        verbose = True
-    _cleanup()
-    if not type(image) == type(''):
-        import astropy.io.fits as pyfits
-        im_name = '.pysex.fits'
-        pyfits.writeto(im_name, image.transpose())
-    else:
-        im_name = image
-    if not type(imageref) == type(''):
-        import astropy.io.fits as pyfits
-        imref_name = '.pysex.ref.fits'
-        pyfits.writeto(imref_name, imageref.transpose())
-    else:
-        imref_name = imageref
-    conf_file, conf_args = _check_files(conf_file, conf_args, verbose)
-    _setup(conf_file, params)
-    cmd = _get_cmd(im_name, imref_name, conf_args)
-    res = os.system(cmd)
-    if res:
+    if runner is None:
+        runner = _getrunner(conf_file)
+    verbose = not ('VERBOSE_TYPE' in conf_args and
+                   conf_args['VERBOSE_TYPE'] == 'QUIET')
+    try:
+        return runner.run(image, imageref=imageref, params=params,
+                          conf_args=conf_args, keepcat=keepcat, rerun=rerun,
+                          catdir=catdir, verbose=verbose)
+    except RuntimeError as err:
         print("Error during sextractor execution!")
-        _cleanup()
+        print(err)
         return
-
-    # Keeping the cat at a permanent location :
-    if keepcat and type(image) == type(''):
-        shutil.copy('.pysex.cat', catpath)
-
-    # Returning the cat :
-    cat = _read_cat()
-    _cleanup()
-    return cat
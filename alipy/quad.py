@@ -5,14 +5,16 @@ Quads are asterisms of 4 stars, used to match the catalogs.
 import sys
 import os
 import math
+import logging
 import numpy as np
 import operator  # For sorting
 import copy
 import itertools
-import scipy.spatial
 
 from alipy import star
 
+logger = logging.getLogger(__name__)
+
 
 class Quad:
     """
@@ -90,8 +92,48 @@ class Quad:
         assert self.hash[0] <= self.hash[2]
         assert self.hash[0] + self.hash[2] <= 1
 
-        self.stars = [A, B, C, D]
+        self._stars = [A, B, C, D]
             # Order might be different from the fourstars !
+        self.table = None
+        self.indexes = None
+        self.level = None  # the quadlevel at which an ImgCat made the quad
+
+    @classmethod
+    def fromtable(cls, table, indexes, hash, level=None):
+        """
+        Builds a Quad from precomputed arrays, as returned by
+        makequadarrays().
+
+        :param table: the StarTable the quad is made of
+        :param indexes: the indexes of the stars A, B, C, D in the table
+        :param hash: the 4 hash values
+        :param level: the quadlevel of the quad, if known
+        """
+        quad = cls.__new__(cls)
+        quad.hash = tuple(hash)
+        quad.table = table
+        quad.indexes = tuple(indexes)
+        quad.level = level
+        quad._stars = None
+        return quad
+
+    @property
+    def stars(self):
+        """
+        The stars A, B, C, D. For quads built from a StarTable, the Star
+        objects are only made on request.
+        """
+        if self._stars is None:
+            self._stars = [self.table[i] for i in self.indexes]
+        return self._stars
+
+    def coords(self):
+        """
+        Returns the coords of the stars A, B, C, D as a (4, 2) array.
+        """
+        if self.table is not None:
+            return self.table.coords()[list(self.indexes)]
+        return star.listtoarray(self.stars)
 
     def __str__(self):
         return "Hash : %6.3f %6.3f %6.3f %6.3f / IDs : (%s, %s, %s, %s)" % (
@@ -109,6 +151,93 @@ def mindist(fourstars):
     return np.min(dists)
 
 
+# The 6 pairs of stars of a quad, and for each pair the 2 other stars :
+_tests = np.array([(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)])
+_other = np.array([(2, 3), (1, 3), (1, 2), (0, 3), (0, 2), (0, 1)])
+
+
+def makequadarrays(coords, combis, d=0.0):
+    """
+    Batched version of the Quad construction : builds many quads at once,
+    giving exactly the same hashes and star orders as the Quad class.
+
+    :param coords: (N, 2) array of star coordinates
+    :param combis: (K, 4) array of star indexes (rows of coords) to combine
+    :param d: minimal distance between stars, as for mindist()
+    :type d: float
+
+    Returns a tuple (hashes, indexes, keep) :
+     * hashes : (K, 4) array of the quad hashes
+     * indexes : (K, 4) array of the star indexes, in the order A, B, C, D
+     * keep : (K,) boolean array, True if all stars of the quad are further
+              apart than d. Hashes of the other quads are not meaningful.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    combis = np.asarray(combis, dtype=np.intp).reshape(-1, 4)
+    nquads = len(combis)
+    rows = np.arange(nquads)
+
+    xs = coords[combis, 0]  # (K, 4)
+    ys = coords[combis, 1]
+    dists = np.sqrt((xs[:, _tests[:, 0]] - xs[:, _tests[:, 1]]) ** 2 +
+                    (ys[:, _tests[:, 0]] - ys[:, _tests[:, 1]]) ** 2)
+    keep = np.min(dists, axis=1) > d if nquads > 0 \
+        else np.zeros(0, dtype=bool)
+
+    maxindex = np.argmax(dists, axis=1) if nquads > 0 \
+        else np.zeros(0, dtype=np.intp)
+    order = np.column_stack((_tests[maxindex], _other[maxindex]))  # A B C D
+    (Ax, Bx, Cx, Dx) = xs[rows[:, None], order].T
+    (Ay, By, Cy, Dy) = ys[rows[:, None], order].T
+
+    # Transform [[a -b], [b a]] + [c d] that brings A and B to 00 11,
+    # same formulas as in Quad :
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = Bx - Ax
+        y = By - Ay
+        b = (x - y) / (x * x + y * y)
+        a = (1.0 / x) * (1.0 + b * y)
+        c = b * Ay - a * Ax
+        d = - (b * Ax + a * Ay)
+
+    xC = a * Cx - b * Cy + c
+    yC = b * Cx + a * Cy + d
+    xD = a * Dx - b * Dy + c
+    yD = b * Dx + a * Dy + d
+
+    # Break symmetries :
+    testa = xC > xD
+    testb = xC + xD > 1
+    switchcd = np.logical_and(testa, np.logical_not(testb))
+    switchall = np.logical_and(testb, np.logical_not(testa))
+    switchab = np.logical_and(testa, testb)
+
+    hashes = np.column_stack((xC, yC, xD, yD))
+    hashes[switchcd] = np.column_stack((xD, yD, xC, yC))[switchcd]
+    hashes[switchall] = np.column_stack((1.0 - xD, 1.0 - yD,
+                                         1.0 - xC, 1.0 - yC))[switchall]
+    hashes[switchab] = np.column_stack((1.0 - xC, 1.0 - yC,
+                                        1.0 - xD, 1.0 - yD))[switchab]
+
+    swaps = np.tile(np.arange(4), (nquads, 1))
+    swaps[switchcd] = (0, 1, 3, 2)
+    swaps[switchall] = (1, 0, 3, 2)
+    swaps[switchab] = (1, 0, 2, 3)
+    indexes = combis[rows[:, None], order[rows[:, None], swaps]]
+
+    return (hashes, indexes, keep)
+
+
+def quadsfromcombis(table, combis, d=0.0):
+    """
+    Builds the list of Quads for the (K, 4) array of star indexes combis of
+    the StarTable table, skipping the quads with stars closer than d.
+    """
+    (hashes, indexes, keep) = makequadarrays(table.coords(), combis, d)
+    return [Quad.fromtable(table, quadindexes, quadhash) for
+            (quadindexes, quadhash) in zip(indexes[keep], hashes[keep])]
+
+
 def makequads1(starlist, n=7, s=0, d=50.0, verbose=True):
     """
     First trivial quad maker.
@@ -123,18 +252,17 @@ def makequads1(starlist, n=7, s=0, d=50.0, verbose=True):
     :param d: minimal distance between stars
     :type d: float
 
+    starlist can be a list of Star objects or a StarTable.
     """
-    quadlist = []
-    sortedstars = star.sortstarlistbyflux(starlist)
-
-    for fourstars in itertools.combinations(sortedstars[s:s + n], 4):
-        if mindist(fourstars) > d:
-            quadlist.append(Quad(fourstars))
+    table = star.listtotable(starlist)
+    brightest = table.fluxorder()[s:s + n]
+    combis = np.array(list(itertools.combinations(brightest, 4)),
+                      dtype=np.intp)
+    quadlist = quadsfromcombis(table, combis, d)
 
     if verbose:
-        print((("Made %4i quads from %4i "
-               "stars (combi n=%i s=%i d=%.1f)") % (len(quadlist),
-                                                    len(starlist), n, s, d)))
+        logger.info("Made %4i quads from %4i stars (combi n=%i s=%i d=%.1f)",
+                    len(quadlist), len(starlist), n, s, d)
     return quadlist
 
 
@@ -152,29 +280,25 @@ def makequads2(starlist, f=5.0, n=6, s=0, d=50.0, verbose=True):
     :param s: number of brightest stars to skip in each subarea
     :type s: int
 
+    starlist can be a list of Star objects or a StarTable.
     """
-    quadlist = []
-    sortedstars = star.sortstarlistbyflux(starlist)
-    (xmin, xmax, ymin, ymax) = star.area(sortedstars)
+    table = star.listtotable(starlist)
+    (xmin, xmax, ymin, ymax) = star.area(table)
 
     r = 2.0 * max(xmax - xmin, ymax - ymin) / f
 
+    combis = []
     for xc in np.linspace(xmin, xmax, f + 2)[1:-1]:
         for yc in np.linspace(ymin, ymax, f + 2)[1:-1]:
-            cstar = star.Star(x=xc, y=yc)
-            das = cstar.distanceandsort(sortedstars)
-            # closest = [s["star"] for s in das[0:4]]
-            brightestwithinr = star.sortstarlistbyflux(
-                [element["star"] for element in das if element["dist"] <= r])[s:s + n]
-            for fourstars in itertools.combinations(brightestwithinr, 4):
-                if mindist(fourstars) > d:
-                    quadlist.append(Quad(fourstars))
+            brightestwithinr = table.brightestwithin(xc, yc, r, n, s=s)
+            combis.extend(itertools.combinations(brightestwithinr.tolist(),
+                                                 4))
+    quadlist = quadsfromcombis(table, np.array(combis, dtype=np.intp), d)
 
     if verbose:
-        print((("Made %4i quads from %4i stars "
-               "(combi sub f=%.1f n=%i s=%i d=%.1f)") % (len(quadlist),
-                                                         len(starlist),
-                                                         f, n, s, d)))
+        logger.info("Made %4i quads from %4i stars "
+                    "(combi sub f=%.1f n=%i s=%i d=%.1f)", len(quadlist),
+                    len(starlist), f, n, s, d)
     return quadlist
 
 
@@ -196,10 +320,156 @@ def removeduplicates(quadlist, verbose=True):
     ui[1:] = (diff >= 0.000001).any(axis=1)
     # print hasharray[ui==False]
     if verbose:
-        print(("Removing %i/%i duplicates" % (len(quadlist) - np.sum(ui),
-                                             len(quadlist))))
+        logger.info("Removing %i/%i duplicates", len(quadlist) - np.sum(ui),
+                    len(quadlist))
+
+    # ui is in the sorted order :
+    keep = np.zeros(len(quadlist), dtype=bool)
+    keep[order[ui]] = True
+    return [quad for (quad, u) in zip(quadlist, keep) if u == True]
 
-    return [quad for (quad, u) in zip(quadlist, ui) if u == True]
+
+def hashkeys(hashes, tol=0.000001):
+    """
+    Quantizes the (K, 4) array of hashes into K hashable tuples : quads with
+    the same key have identical hashes, up to tol.
+    """
+    hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+    return [tuple(key) for key in np.round(hashes / tol).astype(np.int64)]
+
+
+def newunique(quadlist, hashes, seenkeys, verbose=True, nold=0):
+    """
+    Removes the duplicates from new quads : those whose hash is already in
+    the set seenkeys (see hashkeys), or that appear twice in quadlist.
+    Unlike removeduplicates, the cost does not depend on the number of old
+    quads.
+
+    Returns the list of unique new quads and the array of their hashes, and
+    adds their keys to seenkeys.
+
+    :param hashes: the (K, 4) array of the hashes of the K quads of quadlist.
+    :param nold: number of old quads, for the verbose message only.
+    """
+    hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+    keep = np.zeros(len(quadlist), dtype=bool)
+    for (i, key) in enumerate(hashkeys(hashes)):
+        if key not in seenkeys:
+            seenkeys.add(key)
+            keep[i] = True
+    if verbose:
+        logger.info("Removing %i/%i duplicates",
+                    len(quadlist) - np.sum(keep), nold + len(quadlist))
+    return ([q for (q, k) in zip(quadlist, keep) if k], hashes[keep])
+
+
+class QuadIndex:
+    """
+    An index of quads, for fast nearest neighbour searches in the 4D space
+    of the quad hashes.
+
+    The quads are added by chunks (typically one chunk per quadlevel), and
+    each chunk gets its own cKDTree : adding quads never rebuilds the trees
+    of the previous chunks. Quads are numbered in the order they were added,
+    and the index can be used like a list of these quads.
+    """
+
+    def __init__(self, quadlist=None):
+        self.quadlist = []
+        self.trees = []
+        self.offsets = []  # index of the first quad of each tree
+        self.levels = []  # quadlevel of each tree, or None
+        self._views = {}  # the indexes returned by uptolevel
+        if quadlist is not None:
+            self.add(quadlist)
+
+    def __len__(self):
+        return len(self.quadlist)
+
+    def __getitem__(self, i):
+        return self.quadlist[i]
+
+    def __iter__(self):
+        return iter(self.quadlist)
+
+    def add(self, quadlist, hashes=None, level=None):
+        """
+        Adds a chunk of quads to the index.
+
+        :param hashes: optional (K, 4) array of the hashes of the quads, if
+                       already available.
+        :param level: the quadlevel of these quads, used by uptolevel.
+        """
+        if len(quadlist) == 0:
+            return
+        if hashes is None:
+            hashes = np.array([q.hash for q in quadlist])
+        hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+        import scipy.spatial
+        self.offsets.append(len(self.quadlist))
+        self.trees.append(scipy.spatial.cKDTree(hashes))
+        self.levels.append(level)
+        self.quadlist.extend(quadlist)
+        self._views = {}
+
+    def uptolevel(self, level):
+        """
+        Returns a QuadIndex with only the chunks of quads of quadlevels lower
+        than level (and the chunks without level), that shares the trees
+        of this one. It is meant to be read only.
+        """
+        if level not in self._views:
+            nchunks = 0
+            while nchunks < len(self.trees) and \
+                (self.levels[nchunks] is None or
+                 self.levels[nchunks] < level):
+                nchunks += 1
+            if nchunks == len(self.trees):
+                return self
+            view = QuadIndex()
+            view.quadlist = self.quadlist[:self.offsets[nchunks]]
+            view.trees = self.trees[:nchunks]
+            view.offsets = self.offsets[:nchunks]
+            view.levels = self.levels[:nchunks]
+            self._views[level] = view
+        return self._views[level]
+
+    def nearest(self, hashes, k=1):
+        """
+        For each of the hashes (array of shape (M, 4)), finds the k nearest
+        quads of the index.
+        Returns (dists, indexes), two arrays of shape (M, k), sorted by
+        distance. If the index has less than k quads, the missing
+        neighbours get an infinite distance and the index len(self).
+        """
+        hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+        alldists = [np.full((len(hashes), k), np.inf)]
+        allindexes = [np.full((len(hashes), k), len(self), dtype=np.intp)]
+        for (tree, offset) in zip(self.trees, self.offsets):
+            kt = min(k, tree.n)
+            (dists, indexes) = tree.query(hashes, k=kt)
+            alldists.append(np.asarray(dists).reshape(len(hashes), kt))
+            allindexes.append(
+                np.asarray(indexes).reshape(len(hashes), kt) + offset)
+        alldists = np.hstack(alldists)
+        allindexes = np.hstack(allindexes)
+        order = np.argsort(alldists, axis=1, kind="stable")[:, :k]
+        return (np.take_along_axis(alldists, order, axis=1),
+                np.take_along_axis(allindexes, order, axis=1))
+
+    def withinradius(self, hashes, r):
+        """
+        For each of the hashes (array of shape (M, 4)), finds all the quads
+        of the index within a distance r (e.g. minquaddist).
+        Returns a list of M arrays of indexes.
+        """
+        hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+        found = [[] for h in hashes]
+        for (tree, offset) in zip(self.trees, self.offsets):
+            for (i, indexes) in enumerate(tree.query_ball_point(hashes, r)):
+                found[i].extend([index + offset for index in indexes])
+        return [np.array(sorted(indexes), dtype=np.intp)
+                for indexes in found]
 
 
 def proposecands(uknquadlist, refquadlist, n=5, verbose=True):
@@ -207,32 +477,43 @@ def proposecands(uknquadlist, refquadlist, n=5, verbose=True):
     Function that identifies similar quads between the unknown image and a
     reference.
     Returns a dict of (uknquad, refquad, dist, trans)
+
+    refquadlist can be a list of quads, or a QuadIndex of the reference
+    quads (faster, as its trees are reused).
     """
     # Nothing to do if the quadlists are empty ...
     if len(uknquadlist) == 0 or len(refquadlist) == 0:
         if verbose:
-            print("No quads to propose ...")
+            logger.info("No quads to propose ...")
         return []
 
     if verbose:
-        print((("Finding %i best candidates "
-               "among %i x %i (ukn x ref)") % (n,
-                                               len(uknquadlist), 
-                                               len(refquadlist))))
+        logger.info("Finding %i best candidates among %i x %i (ukn x ref)",
+                    n, len(uknquadlist), len(refquadlist))
     uknhashs = np.array([q.hash for q in uknquadlist])
-    refhashs = np.array([q.hash for q in refquadlist])
+    if not isinstance(refquadlist, QuadIndex):
+        refquadlist = QuadIndex(refquadlist)
 
-    # Brute force...
-    dists = scipy.spatial.distance.cdist(refhashs, uknhashs)
-    uknmindistindexes = np.argmin(dists, axis=0)
+    (dists, indexes) = refquadlist.nearest(uknhashs, k=1)
+    uknmindistindexes = indexes[:, 0]
                                   # For each ukn, the index of the closest ref
-    uknmindist = np.min(dists, axis=0)  # The corresponding distances
+    uknmindist = dists[:, 0]  # The corresponding distances
+    return _makecands(uknquadlist, refquadlist, uknmindist,
+                      uknmindistindexes, n=n, verbose=verbose)
+
+
+def _makecands(uknquadlist, refquadlist, uknmindist, uknmindistindexes, n=5,
+               verbose=True):
+    """
+    Builds the n best candidates, given for each ukn quad the distance to
+    its closest ref quad and the index of this ref quad.
+    """
     uknbestindexes = np.argsort(uknmindist)
 
     candlist = []
     nmax = len(uknbestindexes)
     if verbose:
-        print(("We have a maximum of %i quad pairs" % (nmax)))
+        logger.debug("We have a maximum of %i quad pairs", nmax)
     for i in range(min(n, nmax)):
 
         cand = {"uknquad": uknquadlist[uknbestindexes[i]],
@@ -243,15 +524,98 @@ def proposecands(uknquadlist, refquadlist, n=5, verbose=True):
 
         candlist.append(cand)
         if verbose:
-            print(("Cand %2i (dist. %12.8f) : %s" % (i + 1,
-                                                    cand["dist"],
-                                                    str(cand["trans"]))))
+            logger.debug("Cand %2i (dist. %12.8f) : %s", i + 1,
+                         cand["dist"], cand["trans"])
     return candlist
 
 
+class CandFinder:
+    """
+    Proposes candidates like proposecands, for quads that are added level
+    by level to the QuadIndex of the unknown and of the reference image.
+
+    I keep, for each ukn quad, the distance to its closest ref quad. When
+    quads were added, only the new ukn quads against all ref quads and the
+    old ukn quads against the new ref quads are searched, so the work per
+    level is proportional to the number of new quads. The candidates are
+    the same as those of proposecands.
+
+    self.nqueries counts the hashes searched in the KD-trees so far.
+    """
+
+    def __init__(self):
+        self.nqueries = 0
+        self._reset()
+
+    def _reset(self):
+        self.ukntrees = []  # the trees of the ukn index already processed
+        self.reftrees = []  # the trees of the ref index already processed
+        self.uknhashes = np.zeros((0, 4))
+        self.uknmindist = np.zeros(0)
+        self.uknmindistindexes = np.zeros(0, dtype=np.intp)
+
+    def update(self, uknindex, refindex):
+        """
+        Processes the quads added to the indexes since the last update. If
+        some quads were removed (the index is not just longer), I start
+        again from scratch.
+        """
+        if not (_startswith(uknindex.trees, self.ukntrees) and
+                _startswith(refindex.trees, self.reftrees)):
+            self._reset()
+
+        # The old ukn quads against the new ref quads. For equal distances,
+        # the earlier ref quads win, as in QuadIndex.nearest :
+        for (tree, offset) in zip(refindex.trees[len(self.reftrees):],
+                                  refindex.offsets[len(self.reftrees):]):
+            if len(self.uknhashes) == 0:
+                break
+            (dists, indexes) = tree.query(self.uknhashes, k=1)
+            self.nqueries += len(self.uknhashes)
+            better = dists < self.uknmindist
+            self.uknmindist[better] = dists[better]
+            self.uknmindistindexes[better] = indexes[better] + offset
+        self.reftrees = refindex.trees[:]
+
+        # The new ukn quads against all the ref quads :
+        newtrees = uknindex.trees[len(self.ukntrees):]
+        if len(newtrees) > 0:
+            newhashes = np.vstack([tree.data for tree in newtrees])
+            (dists, indexes) = refindex.nearest(newhashes, k=1)
+            self.nqueries += len(newhashes) * len(refindex.trees)
+            self.uknhashes = np.vstack([self.uknhashes, newhashes])
+            self.uknmindist = np.concatenate([self.uknmindist, dists[:, 0]])
+            self.uknmindistindexes = np.concatenate([self.uknmindistindexes,
+                                                     indexes[:, 0]])
+        self.ukntrees = uknindex.trees[:]
+
+    def propose(self, uknindex, refindex, n=5, verbose=True):
+        """
+        Updates, and returns the n best candidates, as proposecands would do.
+        """
+        if len(uknindex) == 0 or len(refindex) == 0:
+            if verbose:
+                logger.info("No quads to propose ...")
+            return []
+        if verbose:
+            logger.info("Finding %i best candidates among %i x %i "
+                        "(ukn x ref)", n, len(uknindex), len(refindex))
+        self.update(uknindex, refindex)
+        return _makecands(uknindex, refindex, self.uknmindist,
+                          self.uknmindistindexes, n=n, verbose=verbose)
+
+
+def _startswith(trees, oldtrees):
+    """
+    Tells if the list of trees starts with the very same oldtrees.
+    """
+    return len(trees) >= len(oldtrees) and \
+        all([a is b for (a, b) in zip(trees, oldtrees)])
+
+
 def quadtrans(uknquad, refquad):
     """
     Quickly return a transform estimated from the stars A and B of two quads.
     """
-    return star.fitstars(uknquad.stars[:2], refquad.stars[:2])
+    return star.fitstars(uknquad.coords()[:2], refquad.coords()[:2])
 
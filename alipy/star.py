@@ -6,12 +6,16 @@ This module contains stuff for geometric matching algorithms.
 import sys
 import os
 import math
+import logging
 import numpy as np
 import operator  # For sorting
 import copy
 import itertools
-import scipy.linalg
-import scipy.spatial
+
+# scipy.linalg and scipy.spatial are imported by the functions that use
+# them, so that importing alipy stays fast.
+
+logger = logging.getLogger(__name__)
 
 
 class Star:
@@ -109,9 +113,223 @@ class Star:
 
         return returnlist
 
+
+class StarTable:
+    """
+    Columnar representation of a list of sources : each property is stored
+    as a numpy array, so that the matching algorithms can work on arrays
+    without converting Star objects back and forth.
+
+    Indexing with an integer returns a Star object (built on request), while
+    slices, index arrays and boolean masks return a new StarTable.
+    Iterating over a StarTable yields Star objects, so that it can be used
+    wherever a list of stars is expected.
+
+    The columns are not meant to be modified in place.
+    """
+
+    def __init__(self, x=(), y=(), flux=None, fwhm=None, elon=None,
+                 name=None, flags=None, props=None, compact=False):
+        """
+        x, y, flux, fwhm, elon : sequences of floats (same length).
+        name : sequence of strings.
+        flags : sequence of ints, typically the sextractor FLAGS.
+        props : dict of further columns (sequences of the same length),
+                that will end up in the props of the Star objects.
+
+        :param compact: If True, the float columns are stored as float32
+                        (coords() always returns float64).
+        :type compact: boolean
+
+        Missing columns get the same default values as for Star objects.
+        """
+        self.compact = compact
+        dtype = np.float32 if compact else np.float64
+
+        self.x = np.asarray(x, dtype=dtype).reshape(-1)
+        self.y = np.asarray(y, dtype=dtype).reshape(-1)
+        nstars = len(self.x)
+        assert len(self.y) == nstars
+
+        def column(values, default, coltype):
+            if values is None:
+                return np.full(nstars, default, dtype=coltype)
+            values = np.asarray(values, dtype=coltype).reshape(-1)
+            assert len(values) == nstars
+            return values
+
+        self.flux = column(flux, -1.0, dtype)
+        self.fwhm = column(fwhm, -1.0, dtype)
+        self.elon = column(elon, -1.0, dtype)
+        self.flags = column(flags, 0, np.int64)
+        if name is None:
+            self.name = np.full(nstars, "untitled")
+        else:
+            self.name = np.asarray(name).astype(str).reshape(-1)
+            assert len(self.name) == nstars
+        self.props = {}
+        if props is not None:
+            for (key, values) in props.items():
+                self.props[key] = np.asarray(values).reshape(-1)
+                assert len(self.props[key]) == nstars
+
+        self._coords = None
+        self._kdtree = None
+        self._fluxrank = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, key):
+        """
+        An int gives a Star, anything else gives a StarTable.
+        """
+        if isinstance(key, (int, np.integer)):
+            return self.star(key)
+        return self.take(key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.star(i)
+
+    def __str__(self):
+        return "\n".join([str(source) for source in self])
+
+    def star(self, i):
+        """
+        Builds the Star object corresponding to row i.
+        """
+        props = dict([[key, values.item(i)] for (key, values)
+                      in self.props.items()])
+        props["FLAGS"] = self.flags.item(i)
+        return Star(x=self.x[i], y=self.y[i], name=self.name[i],
+                    flux=self.flux[i], props=props,
+                    fwhm=self.fwhm[i], elon=self.elon[i])
+
+    def tolist(self):
+        """
+        Returns a list of Star objects.
+        """
+        return list(self)
+
+    def take(self, indices):
+        """
+        Returns a new StarTable with the selected rows.
+        indices can be a slice, an index array or a boolean mask.
+        """
+        if not isinstance(indices, slice):
+            indices = np.asarray(indices)
+            if indices.dtype != bool:
+                indices = indices.astype(np.intp).reshape(-1)
+        return StarTable(x=self.x[indices], y=self.y[indices],
+                         flux=self.flux[indices], fwhm=self.fwhm[indices],
+                         elon=self.elon[indices], name=self.name[indices],
+                         flags=self.flags[indices],
+                         props=dict([[key, values[indices]] for (key, values)
+                                     in self.props.items()]),
+                         compact=self.compact)
+
+    def coords(self, full=False):
+        """
+        Returns the coords as a 2D float64 array, same layout as
+        listtoarray() : first index is star, second index is x or y.
+
+        :param full: If True, I also include flux, fwhm, elon
+        :type full: boolean
+
+        """
+        if full:
+            return np.column_stack((self.x, self.y, self.flux,
+                                    self.fwhm, self.elon)).astype(np.float64)
+        if self._coords is None:
+            self._coords = np.column_stack(
+                (self.x, self.y)).astype(np.float64)
+        return self._coords
+
+    def kdtree(self):
+        """
+        Returns a scipy.spatial.cKDTree of the coords. It is built on the
+        first call, and kept for the following ones.
+        """
+        if self._kdtree is None:
+            import scipy.spatial
+            self._kdtree = scipy.spatial.cKDTree(self.coords())
+        return self._kdtree
+
+    def fluxorder(self):
+        """
+        Returns the indices that sort the table by flux, highest flux first.
+        Ties are ordered as by sortstarlistbyflux().
+        """
+        return np.argsort(self.flux, kind="stable")[::-1]
+
+    def sortbyflux(self):
+        """
+        Returns a new StarTable sorted by flux, highest flux first !
+        """
+        return self.take(self.fluxorder())
+
+    def brightestwithin(self, xc, yc, r, n, s=0):
+        """
+        Returns the indices of the n brightest stars within a distance r of
+        (xc, yc), after skipping the s brightest ones, using the kdtree().
+
+        The stars are ordered by flux, and stars of equal flux as by the
+        former makequads2 : the furthest first, then the last in fluxorder()
+        first.
+        """
+        if self._fluxrank is None:
+            self._fluxrank = np.empty(len(self), dtype=np.intp)
+            self._fluxrank[self.fluxorder()] = np.arange(len(self))
+        coords = self.coords()
+        # The tree is only used to preselect, the distances are computed
+        # here as for Star objects :
+        found = np.array(self.kdtree().query_ball_point(
+            (xc, yc), r * (1.0 + 1.0e-9)), dtype=np.intp)
+        dists = np.sqrt((xc - coords[found, 0]) ** 2 +
+                        (yc - coords[found, 1]) ** 2)
+        found = found[dists <= r]
+        dists = dists[dists <= r]
+        order = np.lexsort((-self._fluxrank[found], -dists, -self.flux[found]))
+        return found[order][s:s + n]
+
+
 # And now some functions to manipulate list of such stars ###
 
 
+def listtotable(starlist, compact=False):
+    """
+    Transforms a list of Star objects into a StarTable.
+    If starlist is already a StarTable, it is returned as it is.
+
+    The props of the stars are only kept for keys present in all stars.
+    """
+    if isinstance(starlist, StarTable):
+        return starlist
+
+    propkeys = set()
+    if len(starlist) > 0:
+        propkeys = set(starlist[0].props.keys())
+        for source in starlist[1:]:
+            propkeys &= set(source.props.keys())
+    propkeys.discard("FLAGS")
+    flags = None
+    if len(starlist) > 0 and \
+       all(["FLAGS" in source.props for source in starlist]):
+        flags = [source.props["FLAGS"] for source in starlist]
+
+    return StarTable(x=[source.x for source in starlist],
+                     y=[source.y for source in starlist],
+                     flux=[source.flux for source in starlist],
+                     fwhm=[source.fwhm for source in starlist],
+                     elon=[source.elon for source in starlist],
+                     name=[source.name for source in starlist],
+                     flags=flags,
+                     props=dict([[key, [source.props[key] for source
+                                        in starlist]] for key in propkeys]),
+                     compact=compact)
+
+
 def printlist(starlist):
     """
     Prints the stars ...
@@ -128,7 +346,13 @@ def listtoarray(starlist, full=False):
     :param full: If True, I also include flux, fwhm, elon
     :type full: boolean
 
+    starlist can also be a StarTable, in which case no Star object is
+    involved. A numpy array is considered to be already in this form.
     """
+    if isinstance(starlist, StarTable):
+        return starlist.coords(full=full)
+    if isinstance(starlist, np.ndarray):
+        return np.asarray(starlist, dtype=np.float64)
     return np.array([star.coords(full=full) for star in starlist])
 
 
@@ -140,12 +364,13 @@ def area(starlist, border=0.01):
     if len(starlist) == 0:
         return np.array([0, 1, 0, 1])
 
+    a = listtoarray(starlist)
+
     if len(starlist) == 1:
-        star = starlist[0]
-        return np.array([star.x - 0.5, star.x + 0.5,
-                         star.y - 0.5, star.y + 0.5])
+        (x, y) = a[0]
+        return np.array([x - 0.5, x + 0.5,
+                         y - 0.5, y + 0.5])
 
-    a = listtoarray(starlist)
     (xmin, xmax) = (np.min(a[:, 0]), np.max(a[:, 0]))
     (ymin, ymax) = (np.min(a[:, 1]), np.max(a[:, 1]))
     xw = xmax - xmin
@@ -223,17 +448,17 @@ def readmancat(mancatfilepath, verbose="True"):
 
 
 def readsexcat(sexcat, hdu=0, verbose=True,
-               maxflag=3, posflux=True, minfwhm=2.0, propfields=[]):
+               maxflag=3, posflux=True, minfwhm=2.0, propfields=[],
+               table=False, compact=False, n=None):
     """
-    sexcat is either a string (path to a file),
-    or directly an asciidata catalog object as returned by pysex
+    sexcat is either a string (path to a file, ASCII or FITS catalog),
+    or directly a catalog object as returned by pysex
 
     :param hdu: The hdu containing the science data from which I should build
                 the catalog. 0 will select the only available extension.
                 If multihdu, 1 is usually science.
 
-    We read a sextractor catalog with astroasciidata and return a list
-    of stars.
+    We read a sextractor catalog and return a list of stars.
     Minimal fields that must be present in the catalog :
 
         * NUMBER
@@ -261,12 +486,18 @@ def readsexcat(sexcat, hdu=0, verbose=True,
     propfields : list of FIELD NAMES to be added to the props of the stars.
 
     I will always add FLAGS as a propfield by default.
-    """
-    returnlist = []
 
+    :param table: If True, I return a StarTable instead of a list of stars.
+    :type table: boolean
+    :param compact: passed to the StarTable (float32 columns).
+    :type compact: boolean
+    :param n: If given, I keep only the n brightest of the selected
+              sources, sorted by flux as sortstarlistbyflux() would do.
+    :type n: int
+    """
     if isinstance(sexcat, str):
 
-        import asciidata
+        from alipy import pysex
         if not os.path.isfile(sexcat):
             print("Sextractor catalog does not exist :")
             print(sexcat)
@@ -274,9 +505,9 @@ def readsexcat(sexcat, hdu=0, verbose=True,
 
         if verbose:
             print(("Reading %s " % (os.path.split(sexcat)[1])))
-        mycat = asciidata.open(sexcat)
+        mycat = pysex._read_cat(sexcat)
 
-    else:  # then it's already a asciidata object
+    else:  # then it's already a catalog object (asciidata or pysex.ArrayCat)
         mycat = sexcat
 
     # We check for the presence of required fields :
@@ -302,48 +533,76 @@ def readsexcat(sexcat, hdu=0, verbose=True,
                "You have to specify which hdu to use !"))
         sys.exit(1)
 
-    propfields.append("FLAGS")
-    propfields = list(set(propfields))
-
-    if mycat.nrows == 0:
-        if verbose:
-            print("No stars in the catalog :-(")
-    else:
-        for i, num in enumerate(mycat['NUMBER']):
-            if mycat['FLAGS'][i] > maxflag:
-                continue
-            if hdu != 0 and mycat['EXT_NUMBER'][i] != hdu:
-                continue
-            flux = mycat['FLUX_AUTO'][i]
-            if posflux and (flux < 0.0):
-                continue
-            fwhm = mycat['FWHM_IMAGE'][i]
-            if float(fwhm) <= minfwhm:
-                continue
-
-            props = dict([[propfield, mycat[propfield][i]]
-                         for propfield in propfields])
-
-            newstar = Star(
-                x=mycat['X_IMAGE'][i],
-                y=mycat['Y_IMAGE'][i],
-                name=str(num),
-                flux=flux,
-                props=props,
-                fwhm=mycat['FWHM_IMAGE'][i],
-                elon=mycat['ELONGATION'][i])
-            returnlist.append(newstar)
+    propfields = list(set(propfields + ["FLAGS"]))
+
+    def catcolumn(field):
+        if mycat.nrows == 0:
+            return np.array([])
+        return np.asarray(mycat[field].tonumpy())
+
+    if mycat.nrows == 0 and verbose:
+        print("No stars in the catalog :-(")
+
+    # The cuts, on whole columns :
+    flux = catcolumn('FLUX_AUTO')
+    keep = catcolumn('FLAGS') <= maxflag
+    if hdu != 0:
+        keep &= catcolumn('EXT_NUMBER') == hdu
+    if posflux:
+        keep &= ~(flux < 0.0)
+    keep &= ~(catcolumn('FWHM_IMAGE').astype(np.float64) <= minfwhm)
+    keepindexes = np.flatnonzero(keep)
+    nselected = len(keepindexes)
+    if n is not None:
+        keepindexes = keepindexes[_brightest(flux[keepindexes], n)]
+
+    # We build the columns only for the selected sources :
+    def column(field):
+        return catcolumn(field)[keepindexes]
+
+    startable = StarTable(
+        x=column('X_IMAGE'),
+        y=column('Y_IMAGE'),
+        flux=column('FLUX_AUTO'),
+        fwhm=column('FWHM_IMAGE'),
+        elon=column('ELONGATION'),
+        name=column('NUMBER'),
+        flags=column('FLAGS'),
+        props=dict([[propfield, column(propfield)] for propfield
+                    in propfields if propfield != "FLAGS"]),
+        compact=compact)
 
     if verbose:
-        print(("I've selected %i sources" % (len(returnlist))))
+        print(("I've selected %i sources" % (nselected)))
 
-    return returnlist
+    if table:
+        return startable
+    return startable.tolist()
+
+
+def _brightest(flux, n):
+    """
+    Returns the indices of the n highest fluxes, highest first, as
+    np.argsort(flux, kind="stable")[::-1][:n] but without sorting all the
+    fluxes.
+    """
+    if n >= len(flux) or np.any(np.isnan(flux)):
+        return np.argsort(flux, kind="stable")[::-1][:n]
+    if n <= 0:
+        return np.array([], dtype=np.intp)
+    threshold = -np.partition(-flux, n - 1)[n - 1]
+    # All the ties at the threshold are candidates, as in the full sort :
+    candidates = np.flatnonzero(flux >= threshold)
+    order = np.argsort(flux[candidates], kind="stable")[::-1][:n]
+    return candidates[order]
 
 
 def findstar(starlist, nametofind):
     """
     Returns a list of stars for which name == nametofind
     """
+    if isinstance(starlist, StarTable):
+        return starlist.take(starlist.name == nametofind).tolist()
     foundstars = []
     for source in starlist:
         if source.name == nametofind:
@@ -354,7 +613,10 @@ def findstar(starlist, nametofind):
 def sortstarlistbyflux(starlist):
     """
     We sort starlist according to flux : highest flux first !
+    A StarTable gets sorted into a new StarTable.
     """
+    if isinstance(starlist, StarTable):
+        return starlist.sortbyflux()
     sortedstarlist = sorted(starlist, key=operator.itemgetter('flux'))
     sortedstarlist.reverse()
     return sortedstarlist
@@ -364,7 +626,11 @@ def sortstarlistby(starlist, measure):
     """
     We sort starlist according to measure : lowest first !
     Where measure is one of flux, fwhm, elon
+    A StarTable gets sorted into a new StarTable.
     """
+    if isinstance(starlist, StarTable):
+        return starlist.take(np.argsort(getattr(starlist, measure),
+                                        kind="stable"))
     sortedstarlist = sorted(starlist, key=operator.itemgetter(measure))
     return sortedstarlist
 
@@ -400,19 +666,14 @@ class SimpleTransform:
         """
         Returns the inverse transform !
         """
+        return SimpleTransform(inversetransforms(self.v))
 
-        # To represent affine transformations with matrices, we can use
-        # homogeneous coordinates.
-        homo = np.array([
-                        [self.v[0], -self.v[1], self.v[2]],
-                        [self.v[1],  self.v[0], self.v[3]],
-                        [0.0, 0.0, 1.0]
-                        ])
-
-        inv = scipy.linalg.inv(homo)
-        # print inv
-
-        return SimpleTransform((inv[0, 0], inv[1, 0], inv[0, 2], inv[1, 2]))
+    def compose(self, other):
+        """
+        Returns the transform that corresponds to applying self, and then
+        other.
+        """
+        return SimpleTransform(composetransforms(self.v, other.v))
 
     def matrixform(self):
         """
@@ -433,16 +694,76 @@ class SimpleTransform:
         yn = self.v[1] * x + self.v[0] * y + self.v[3]
         return (xn, yn)
 
+    def applyarray(self, xy):
+        """
+        Applies the transform to an array of points of shape (N, 2),
+        as returned by listtoarray(). Returns a new (N, 2) array.
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        return np.column_stack(self.apply(xy.T))
+
     def applystar(self, star):
         transstar = star.copy()
         (transstar.x, transstar.y) = self.apply((transstar.x, transstar.y))
         return transstar
 
     def applystarlist(self, starlist):
+        """
+        A StarTable gives a new StarTable, a list of stars gives a list.
+        """
+        if isinstance(starlist, StarTable):
+            (x, y) = self.applyarray(starlist.coords()).T
+            return StarTable(x=x, y=y, flux=starlist.flux,
+                             fwhm=starlist.fwhm, elon=starlist.elon,
+                             name=starlist.name, flags=starlist.flags,
+                             props=starlist.props, compact=starlist.compact)
         return [self.applystar(star) for star in starlist]
 
 
-def fitstars(uknstars, refstars, verbose=True):
+def inversetransforms(v):
+    """
+    Inverts transforms given by their parameters v = (a, b, c, d), as an
+    array of shape (4,) or (K, 4). Returns an array of the same shape.
+
+    As the matrix [[a -b], [b a]] is a scaled rotation, the inverse is
+    simply [[a b], [-b a]] / (a*a + b*b).
+    """
+    v = np.asarray(v, dtype=np.float64)
+    (a, b, c, d) = np.moveaxis(v, -1, 0)
+    s = a * a + b * b
+    return np.stack((a / s, -b / s,
+                     -(a * c + b * d) / s, (b * c - a * d) / s), axis=-1)
+
+
+def composetransforms(first, second):
+    """
+    Composes transforms given by their parameters, as arrays of shape (4,)
+    or (K, 4) (broadcasted against each other).
+    Returns the parameters of the transforms that apply first, and then
+    second.
+    """
+    (a1, b1, c1, d1) = np.moveaxis(np.asarray(first, dtype=np.float64), -1, 0)
+    (a2, b2, c2, d2) = np.moveaxis(np.asarray(second, dtype=np.float64),
+                                   -1, 0)
+    return np.stack((a2 * a1 - b2 * b1, a2 * b1 + b2 * a1,
+                     a2 * c1 - b2 * d1 + c2, b2 * c1 + a2 * d1 + d2),
+                    axis=-1)
+
+
+def applytransforms(v, xy):
+    """
+    Applies K transforms, given by their parameters v as an array of shape
+    (K, 4), to the N points of the array xy of shape (N, 2).
+    Returns an array of shape (K, N, 2), the same values as applyarray.
+    """
+    v = np.asarray(v, dtype=np.float64).reshape(-1, 4)
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    (a, b, c, d) = [col[:, None] for col in v.T]
+    (x, y) = (xy[None, :, 0], xy[None, :, 1])
+    return np.stack((a * x - b * y + c, b * x + a * y + d), axis=-1)
+
+
+def fitstars(uknstars, refstars, verbose=True, weights=None):
     """
     I return the transform that puts the unknown stars (uknstars)
     onto the refstars.
@@ -453,31 +774,110 @@ def fitstars(uknstars, refstars, verbose=True):
 
     Formalism inspired by:
     http://math.stackexchange.com/questions/77462/
+
+    :param weights: optional weights of the stars, for the least squares.
     """
 
     assert len(uknstars) == len(refstars)
     if len(uknstars) < 2:
         if verbose:
-            print("Sorry I cannot fit a transform on less than 2 stars.")
+            logger.warning("Sorry I cannot fit a transform on less than 2 "
+                           "stars.")
         return None
 
-    # ukn * x = ref
-    # x is the transform (a, b, c, d)
+    return SimpleTransform(fitarrays(listtoarray(uknstars),
+                                     listtoarray(refstars), weights=weights))
 
-    ref = np.hstack(listtoarray(refstars))  # a 1D vector of lenth 2n
 
-    uknlist = []
-    for star in uknstars:
-        uknlist.append([star.x, -star.y, 1, 0])
-        uknlist.append([star.y, star.x, 0, 1])
-    ukn = np.vstack(np.array(uknlist))  # a matrix
+def fitarrays(ukn, ref, weights=None):
+    """
+    Same as fitstars, for coordinate arrays of shape (N, 2), with N >= 2.
+    Returns the parameters (a, b, c, d) of the transform.
+    """
+    # ukn * x = ref
+    # x is the transform (a, b, c, d)
 
-    if len(uknstars) == 2:
+    ref = np.asarray(ref, dtype=np.float64).reshape(-1)
+                                              # a 1D vector of lenth 2n
+
+    # The design matrix, two rows per star :
+    (x, y) = np.asarray(ukn, dtype=np.float64).reshape(-1, 2).T
+    ukn = np.zeros((2 * len(x), 4))
+    ukn[0::2, 0] = x
+    ukn[0::2, 1] = -y
+    ukn[0::2, 2] = 1.0
+    ukn[1::2, 0] = y
+    ukn[1::2, 1] = x
+    ukn[1::2, 3] = 1.0
+
+    if weights is not None:
+        sqrtweights = np.repeat(np.sqrt(np.asarray(weights,
+                                                   dtype=np.float64)), 2)
+        ukn = ukn * sqrtweights[:, None]
+        ref = ref * sqrtweights
+
+    import scipy.linalg
+    if len(x) == 2:
         trans = scipy.linalg.solve(ukn, ref)
     else:
         trans = scipy.linalg.lstsq(ukn, ref)[0]
 
-    return SimpleTransform(np.asarray(trans))
+    return np.asarray(trans)
+
+
+def refinetrans(uknstars, refstars, trans, r=5.0, nsigma=3.0, maxiter=10,
+                weights=None, verbose=True):
+    """
+    Refits the transform trans on the matching stars, iteratively.
+
+    The first iteration fits all the matches that identify() finds with
+    trans. The next ones identify the matches again with the new transform,
+    but leave out of the fit those further than nsigma times the RMS of the
+    distances of the previous fit. This goes on until the fitted stars do
+    not change anymore, or for maxiter iterations. The KD-tree of the
+    refstars is used for all iterations (if refstars is a StarTable).
+
+    :param nsigma: clipping threshold, None for no clipping.
+    :param weights: optional weights of the uknstars for the fit, e.g.
+                    from their fluxes.
+
+    Returns (trans, uknmatchstars, refmatchstars, rms) : the refitted
+    transform, the matching stars as identify(getstars=True) would return
+    them with this transform, and the RMS of the distances of the fitted
+    stars.
+    """
+    ukn = listtoarray(uknstars)
+    ref = listtoarray(refstars)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+    fitmask = None
+    rms = None
+    for iteration in range(maxiter):
+        (firstdists, seconddists, nearestrefs) = _nearesttwo(
+            trans.applyarray(ukn), refstars)
+        matches = np.logical_and(firstdists <= r,
+                                 seconddists > 2.0 * firstdists)
+        newfitmask = matches.copy()
+        if nsigma is not None and rms is not None:
+            newfitmask &= firstdists <= nsigma * rms
+        if np.sum(newfitmask) < 2 or \
+           (fitmask is not None and np.array_equal(newfitmask, fitmask)):
+            break
+        fitmask = newfitmask
+        trans = SimpleTransform(fitarrays(
+            ukn[fitmask], ref[nearestrefs[fitmask]],
+            weights=None if weights is None else weights[fitmask]))
+        residuals = np.sqrt(np.sum((trans.applyarray(ukn[fitmask]) -
+                                    ref[nearestrefs[fitmask]]) ** 2, axis=1))
+        rms = float(np.sqrt(np.mean(residuals ** 2)))
+        if verbose:
+            logger.info("Iteration %i : fitted %i/%i matches, rms %.3f",
+                        iteration + 1, np.sum(fitmask), np.sum(matches), rms)
+
+    (uknmatchstars, refmatchstars) = identify(uknstars, refstars,
+                                              trans=trans, r=r,
+                                              verbose=verbose, getstars=True)
+    return (trans, uknmatchstars, refmatchstars, rms)
 
 
 #     def teststars(self, uknstars, refstars, r=5.0, verbose=True):
@@ -533,7 +933,8 @@ def fitstars(uknstars, refstars, verbose=True):
 
 
 def identify(uknstars, refstars,
-             trans=None, r=5.0, verbose=True, getstars=False):
+             trans=None, r=5.0, verbose=True, getstars=False,
+             engine="kdtree"):
     """
     Allows to:
      * get the number or matches, i.e. evaluate the quality of the trans
@@ -541,53 +942,164 @@ def identify(uknstars, refstars,
 
     :param getstars: If True, I return two lists of corresponding stars,
                      instead of just the number of matching stars
+                     (two StarTables if the input are StarTables).
     :type getstars: boolean
 
+    :param engine: "kdtree" uses a single k=2 nearest neighbour query on a
+                   KD-tree of the refstars (cached if refstars is a
+                   StarTable), "cdist" uses the full table of distances.
+    :type engine: string
+
     Inspired by the "formpairs" of alipy 1.0 ...
     """
 
+    ukn = listtoarray(uknstars)
     if trans != None:
-        ukn = listtoarray(trans.applystarlist(uknstars))
+        ukn = trans.applyarray(ukn)
+
+    if engine == "kdtree":
+        (firstdists, seconddists, nearestrefs) = _nearesttwo(ukn, refstars)
+    elif engine == "cdist":
+        import scipy.spatial
+        ref = listtoarray(refstars)
+        dists = scipy.spatial.distance.cdist(
+            ukn, ref)  # Big table of distances between ukn and ref
+        sortedrefs = np.argsort(dists, axis=1)[:, :2]
+        nearestrefs = sortedrefs[:, 0]
+        (firstdists, seconddists) = np.take_along_axis(dists, sortedrefs,
+                                                       axis=1).T
     else:
-        ukn = listtoarray(uknstars)
-    ref = listtoarray(refstars)
+        raise RuntimeError("Unknown engine %s" % (engine))
 
-    dists = scipy.spatial.distance.cdist(
-        ukn, ref)  # Big table of distances between ukn and ref
-    mindists = np.min(dists, axis=1)  # For each ukn, the minimal distance
+    mindists = firstdists  # For each ukn, the minimal distance
     minok = mindists <= r  # booleans for each ukn
-    minokindexes = np.argwhere(
-        minok).flatten()  # indexes of uknstars with matches
 
-    if verbose:
-        print((("%i/%i stars with distance < r "
-               "= %.1f (mean %.1f, "
-               "median %.1f, std %.1f)") % (np.sum(minok), len(uknstars), r,
-                                            np.mean(mindists[minok]),
-                                            np.median(mindists[minok]),
-                                            np.std(mindists[minok]))))
-    matchuknstars = []
-    matchrefstars = []
-
-    for i in minokindexes:  # we look for the second nearest ...
-        sortedrefs = np.argsort(dists[i, :])
-        firstdist = dists[i, sortedrefs[0]]
-        seconddist = dists[i, sortedrefs[1]]
-        if seconddist > 2.0 * firstdist:  # Then the situation is clear,
-                                          # we keep it.
-            matchuknstars.append(uknstars[i])
-            matchrefstars.append(refstars[sortedrefs[0]])
-        else:
-            pass  # Then there is a companion, we skip it.
+    if verbose and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%i/%i stars with distance < r = %.1f (mean %.1f, "
+                     "median %.1f, std %.1f)", np.sum(minok), len(uknstars),
+                     r, np.mean(mindists[minok]), np.median(mindists[minok]),
+                     np.std(mindists[minok]))
 
-    if verbose:
-        print(("Filtered for companions, keeping %i/%i matches" %
-              (len(matchuknstars), np.sum(minok))))
+    # If the second nearest is far enough, the situation is clear and
+    # we keep it. Otherwise there is a companion, and we skip it.
+    keep = np.logical_and(minok, seconddists > 2.0 * firstdists)
+    matchuknindexes = np.flatnonzero(keep)
+    matchrefindexes = nearestrefs[keep]
+
+    if verbose and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Filtered for companions, keeping %i/%i matches",
+                     len(matchuknindexes), np.sum(minok))
 
     if getstars == True:
-        return (matchuknstars, matchrefstars)
+        return (_select(uknstars, matchuknindexes),
+                _select(refstars, matchrefindexes))
     else:
-        return len(matchuknstars)
+        return len(matchuknindexes)
+
+
+def hasmatches(uknstars, refstars, trans, minnident, r=5.0, verbose=True,
+               chunksize=32, getntested=False):
+    """
+    Tells if identify(uknstars, refstars, trans, r) would find at least
+    minnident matches, usually without testing all the uknstars.
+
+    The uknstars that the trans puts further than r from the bounding box of
+    the refstars cannot match, and are skipped. The others are tested by
+    chunks, in their order (so put the brightest first) : a match of
+    identify only depends on its own ukn star, so I stop as soon as
+    minnident matches are found, or as soon as the remaining stars cannot
+    provide enough of them. The answer is always the same as with identify.
+
+    :param chunksize: number of stars tested in the first chunk, the next
+                      chunks are twice as large as the previous one.
+    :type chunksize: int
+
+    :param getntested: If True, I return (ok, ntested), where ntested is the
+                       number of stars that were actually searched in the
+                       KD-tree of the refstars.
+    :type getntested: boolean
+    """
+    ukn = listtoarray(uknstars)
+    if trans != None:
+        ukn = trans.applyarray(ukn)
+    ref = listtoarray(refstars)
+    if len(ref) == 0:
+        inarea = np.zeros(len(ukn), dtype=bool)
+    else:
+        (refmin, refmax) = (np.min(ref, axis=0), np.max(ref, axis=0))
+        inarea = np.all(np.logical_and(ukn >= refmin - r, ukn <= refmax + r),
+                        axis=1)
+    candidates = ukn[inarea]
+
+    nident = 0
+    ntested = 0
+    while nident < minnident and nident + len(candidates) - ntested >= \
+            minnident:
+        chunk = candidates[ntested:ntested + chunksize]
+        (firstdists, seconddists, nearestrefs) = _nearesttwo(chunk, refstars)
+        nident += int(np.sum(np.logical_and(firstdists <= r,
+                                            seconddists > 2.0 * firstdists)))
+        ntested += len(chunk)
+        chunksize *= 2
+
+    ok = nident >= minnident
+    if verbose:
+        logger.debug("%s after testing %i/%i stars (%i in the reference "
+                     "area), %i matches", "Accepted" if ok else "Rejected",
+                     ntested, len(ukn), len(candidates), nident)
+    if getntested:
+        return (ok, ntested)
+    return ok
+
+
+def countmatches(uknstars, refstars, transes, r=5.0):
+    """
+    Returns, for each of the transforms transes (a list of SimpleTransform
+    objects, or an array of their parameters of shape (K, 4)), the number of
+    matches that identify(uknstars, refstars, trans, r) would find.
+
+    All the transformed uknstars go through a single query of the KD-tree
+    of the refstars.
+    """
+    if isinstance(transes, np.ndarray):
+        v = transes.reshape(-1, 4)
+    else:
+        v = np.array([trans.v for trans in transes],
+                     dtype=np.float64).reshape(-1, 4)
+    ukn = listtoarray(uknstars)
+    if len(v) == 0 or len(ukn) == 0:
+        return np.zeros(len(v), dtype=np.intp)
+    transukn = applytransforms(v, ukn)
+    (firstdists, seconddists, nearestrefs) = _nearesttwo(
+        transukn.reshape(-1, 2), refstars)
+    ok = np.logical_and(firstdists <= r, seconddists > 2.0 * firstdists)
+    return np.sum(ok.reshape(len(v), len(ukn)), axis=1)
+
+
+def _nearesttwo(ukn, refstars):
+    """
+    For each row of the coordinate array ukn, finds the two nearest refstars.
+    Returns (firstdists, seconddists, nearestrefs). If there is only one
+    refstar, the seconddists are inf.
+    """
+    if len(ukn) == 0:
+        return (np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.intp))
+    if isinstance(refstars, StarTable):
+        tree = refstars.kdtree()
+    else:
+        import scipy.spatial
+        tree = scipy.spatial.cKDTree(listtoarray(refstars))
+    (dists, indexes) = tree.query(ukn, k=2)
+    return (dists[:, 0], dists[:, 1], indexes[:, 0])
+
+
+def _select(stars, indexes):
+    """
+    Picks the stars at the given indexes, from a StarTable or a list.
+    """
+    if isinstance(stars, StarTable):
+        return stars.take(indexes)
+    return [stars[i] for i in indexes]
 
 
 #
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Import-time benchmark of alipy.
+
+Each import is timed in fresh interpreters, and I check that the heavy or
+optional dependencies (scipy.linalg, scipy.spatial, scipy.ndimage,
+astropy.io.fits, asciidata, f2n, pyraf, matplotlib) are not imported by
+importing alipy or its core modules : they should only be imported on first
+use. The exit status is 1 if one of them is, or if an import is slower than
+--maxtime, so that this can be run in a CI job to catch regressions.
+
+Usage : python benchmarks/importtime.py [--repeat 5] [--maxtime 1.0]
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+# What we import, and the modules that must not be imported by it :
+targets = [
+    ("alipy", ["numpy", "scipy", "astropy"]),
+    ("alipy.star", ["scipy.linalg", "scipy.spatial", "astropy"]),
+    ("alipy.quad", ["scipy.linalg", "scipy.spatial", "astropy"]),
+    ("alipy.ident", ["scipy.linalg", "scipy.spatial", "scipy.ndimage",
+                     "astropy"]),
+    ("alipy.align", ["scipy.ndimage", "astropy"]),
+]
+
+optional = ["asciidata", "f2n", "pyraf", "matplotlib"]
+
+_script = """
+import sys, time, json
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+print(json.dumps([t, sorted(sys.modules)]))
+"""
+
+
+def timeimport(module):
+    """
+    Imports module in a fresh interpreter, and returns the time it took
+    and the list of all the modules that got imported.
+    """
+    rootdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [rootdir] + [p for p in [env.get("PYTHONPATH")] if p])
+    output = subprocess.check_output(
+        [sys.executable, "-c", _script % (module)], env=env)
+    (seconds, modules) = json.loads(output.decode().splitlines()[-1])
+    return (seconds, modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of interpreters per import")
+    parser.add_argument("--maxtime", type=float, default=None,
+                        help="maximum median time of an import, in seconds")
+    args = parser.parse_args()
+
+    failed = False
+    for (module, forbidden) in targets:
+        runs = [timeimport(module) for i in range(args.repeat)]
+        times = sorted([seconds for (seconds, modules) in runs])
+        median = times[len(times) // 2]
+        modules = runs[0][1]
+        loaded = [name for name in forbidden + optional if name in modules]
+
+        status = "ok"
+        if len(loaded) > 0:
+            status = "imports %s" % (", ".join(loaded))
+            failed = True
+        if args.maxtime is not None and median > args.maxtime:
+            status = "too slow (max %.3f s)" % (args.maxtime)
+            failed = True
+        print("%-12s median %7.1f ms, min %7.1f ms : %s" % (
+            module, 1000.0 * median, 1000.0 * times[0], status))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()